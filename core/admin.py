@@ -1,21 +1,77 @@
+import datetime
+
 from django.contrib import admin
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund, UserProfile
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import transaction
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils.html import format_html
+from . import bulk, cart, profiling, refunds
+from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund, UserProfile, Job, WebhookEvent, BulkRun, JOB_DONE, ORDER_TOTAL_FIELDS
+
+def run_link(run):
+    return format_html('<a href="{}">{}</a>', reverse('admin:core_bulkrun_change', args=[run.pk]), run)
+
+def issue_refunds(modeladmin, request, refund_queryset):
+    # Refunds are issued by a background job, the run shows its progress
+    run = refunds.accept(refund_queryset)
+    if run:
+        modeladmin.message_user(request, format_html(
+            'Issuing {} refunds, see {} for progress', run.total, run_link(run)))
+
+def update_orders(modeladmin, request, queryset, action):
+    # In chunks, large selections in the background, see core.bulk
+    run = bulk.start(action, queryset)
+    if run.status == JOB_DONE:
+        modeladmin.message_user(request, f'{run.done} orders updated')
+    else:
+        modeladmin.message_user(request, format_html(
+            'Updating the orders in the background, see {} for progress', run_link(run)))
 
 def make_refund_accepted(modeladmin, request, queryset):
-    queryset.update(refund_requested=False, refund_granted=True)
+    update_orders(modeladmin, request, queryset, 'make_refund_accepted')
+    issue_refunds(modeladmin, request, Refund.objects.filter(order__in=queryset.values('pk')))
 
 make_refund_accepted.short_description = 'Update orders to refund granted'
 
+def accept_refunds(modeladmin, request, queryset):
+    Order.objects.filter(refund__in=queryset).update(refund_requested=False)
+    issue_refunds(modeladmin, request, queryset)
+
+accept_refunds.short_description = 'Accept and issue refunds'
+
 def make_delivered(modeladmin, request, queryset):
-    queryset.update(being_delivered=True)
+    update_orders(modeladmin, request, queryset, 'make_delivered')
 
 make_delivered.short_description = 'Update orders to delivered'
 
 def make_received(modeladmin, request, queryset):
-    queryset.update(received=True, being_delivered=False)
+    update_orders(modeladmin, request, queryset, 'make_received')
 
 make_received.short_description = 'Update orders to received'
 
+def resume_runs(modeladmin, request, queryset):
+    # E.g. after the request running them was killed or their job failed.
+    # Runs with a job queued or running are left to it, the rows are locked
+    # so two admins resuming at once queue one job
+    resumed = 0
+    with transaction.atomic():
+        runs = list(queryset.exclude(status=JOB_DONE).select_for_update())
+        for run in runs:
+            module = refunds if run.action == refunds.RUN_ACTION else bulk
+            resumed += module.resume(run)
+    message = f'{resumed} runs resumed'
+    if resumed < len(runs):
+        message += f', {len(runs) - resumed} still have a job queued or running'
+    modeladmin.message_user(request, message)
+
+resume_runs.short_description = 'Resume unfinished runs'
+
+def update_open_order_totals(orders):
+    for order in orders.filter(ordered=False).select_related('coupon'):
+        order.update_totals()
+        cart.forget_item_count(order.user_id)
+
 class OrderAdmin(admin.ModelAdmin):
     list_display = [
         'user',
@@ -27,7 +83,15 @@ class OrderAdmin(admin.ModelAdmin):
          'billing_address',
          'shipping_address',
          'payment',
-         'coupon'
+         'coupon',
+         'order_total'
+    ]
+
+    list_select_related = [
+        'user',
+        'billing_address',
+        'shipping_address',
+        'coupon'
     ]
 
     list_display_links = [
@@ -43,13 +107,17 @@ class OrderAdmin(admin.ModelAdmin):
          'being_delivered',
          'received',
          'refund_requested',
-         'refund_granted'
+         'refund_granted',
+         'payment_problem'
     ]
     
     search_fields = [
         'user__username',
         'ref_code'
     ]
+
+    # Maintained by core.cart, see Order.update_totals
+    readonly_fields = ORDER_TOTAL_FIELDS
     
     actions = [
         make_refund_accepted,
@@ -57,6 +125,34 @@ class OrderAdmin(admin.ModelAdmin):
         make_received
     ]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_totals()
+
+    def order_total(self, obj):
+        return round(obj.order_total, 2)
+
+    order_total.admin_order_field = 'order_total'
+
+    def save_related(self, request, form, formsets, change):
+        # Placed orders keep the totals they were paid at
+        super().save_related(request, form, formsets, change)
+        update_open_order_totals(Order.objects.filter(pk=form.instance.pk))
+
+class ItemAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        update_open_order_totals(Order.objects.filter(items__item=obj).distinct())
+
+class OrderItemAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        update_open_order_totals(obj.order_set.all())
+
+class CouponAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        update_open_order_totals(obj.order_set.all())
+
 class AddressAdmin(admin.ModelAdmin):
     list_display = [
         'user',
@@ -81,12 +177,133 @@ class AddressAdmin(admin.ModelAdmin):
         'zip'
     ]
 
+class RefundAdmin(admin.ModelAdmin):
+    list_display = [
+        'order',
+        'email',
+        'accepted',
+        'refunded',
+        'stripe_refund_id',
+        'error',
+        'run'
+    ]
+
+    list_filter = [
+        'accepted',
+        'run'
+    ]
+
+    actions = [
+        accept_refunds
+    ]
+
+class BulkRunAdmin(admin.ModelAdmin):
+    list_display = [
+        'action',
+        'status',
+        'progress',
+        'failed',
+        'created',
+        'finished'
+    ]
+
+    list_filter = [
+        'action',
+        'status'
+    ]
+
+    readonly_fields = [
+        'action',
+        'status',
+        'total',
+        'done',
+        'failed',
+        'finished',
+        'batch_size',
+        'last_pk'
+    ]
+
+    actions = [
+        resume_runs
+    ]
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = [
+        'name',
+        'status',
+        'attempts',
+        'run_at',
+        'locked_by',
+        'finished'
+    ]
+
+    list_filter = [
+        'status',
+        'name'
+    ]
+
+    search_fields = [
+        'idempotency_key'
+    ]
+
+    readonly_fields = [
+        'locked_by',
+        'locked_until',
+        'last_error',
+        'finished'
+    ]
+
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = [
+        'event_id',
+        'type',
+        'received',
+        'processed'
+    ]
+
+    list_filter = [
+        'type',
+        # Events whose processing failed
+        ('error', admin.EmptyFieldListFilter)
+    ]
+
+    search_fields = [
+        'event_id'
+    ]
+
 # Register your models here.
-admin.site.register(Item)
-admin.site.register(OrderItem)
+admin.site.register(Item, ItemAdmin)
+admin.site.register(OrderItem, OrderItemAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(Payment)
-admin.site.register(Coupon)
-admin.site.register(Refund)
+admin.site.register(Coupon, CouponAdmin)
+admin.site.register(Refund, RefundAdmin)
 admin.site.register(UserProfile)
+admin.site.register(Job, JobAdmin)
+admin.site.register(BulkRun, BulkRunAdmin)
+admin.site.register(WebhookEvent, WebhookEventAdmin)
+
+
+@staff_member_required
+def profiles_view(request):
+    # Recent request profiles per view, with the top cumulative functions of
+    # the selected (or newest) profile
+    profiles = profiling.list_profiles()
+    selected = request.GET.get('profile')
+    paths = [path for entries in profiles.values() for timestamp, path in entries]
+    if selected not in paths:
+        selected = max(paths, key=lambda path: path.rsplit('/', 1)[-1], default=None)
+
+    context = dict(
+        admin.site.each_context(request),
+        title='Request profiles',
+        profiles={
+            label: [(datetime.datetime.fromtimestamp(timestamp), path) for timestamp, path in entries]
+            for label, entries in profiles.items()
+        },
+        selected=selected,
+    )
+    if selected:
+        context['total'], context['functions'] = profiling.top_functions(selected)
+    return render(request, 'admin/profiles.html', context)
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        # checkout and search connect signal receivers on import, bulk,
+        # jobs, refunds and webhooks register their tasks
+        from . import bulk, checkout, jobs, refunds, search, webhooks
+        post_migrate.connect(search.create_index, sender=self)
@@ -0,0 +1,113 @@
+import logging
+import re
+import threading
+from bisect import bisect_left
+
+from django.db import connection
+
+from .models import Item, CATALOG_VERSION
+from .versions import get_version
+
+# Only the first few words of a title are indexed, which bounds the index
+# at MAX_WORDS entries per item (~0.5M tuples for a 100k item catalog)
+MAX_WORDS = 5
+MAX_RESULTS = 20
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+class PrefixIndex:
+    # Sorted array of (title suffix starting at a word, item id); a prefix
+    # lookup is a bisect plus a short forward scan
+    def __init__(self, rows, version=None):
+        self.version = version
+        self.items = {}
+        entries = []
+        for pk, title, slug, price, discount_price, image in rows:
+            self.items[pk] = {
+                'title': title,
+                'slug': slug,
+                'price': discount_price or price,
+                'thumbnail': Item._meta.get_field('image').storage.url(image) if image else None,
+            }
+            words = normalize(title).split(' ')
+            for i in range(min(len(words), MAX_WORDS)):
+                entries.append((' '.join(words[i:]), pk))
+        entries.sort()
+        self.keys = [key for key, pk in entries]
+        self.ids = [pk for key, pk in entries]
+
+    @classmethod
+    def build(cls, version=None):
+        rows = Item.objects.values_list(
+            'id', 'title', 'slug', 'price', 'discount_price', 'image').iterator()
+        return cls(rows, version)
+
+    def lookup(self, prefix, limit=10):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(results) < limit and self.keys[i].startswith(prefix):
+            pk = self.ids[i]
+            if pk not in seen:
+                seen.add(pk)
+                results.append(self.items[pk])
+            i += 1
+        return results
+
+
+_index = None
+_lock = threading.Lock()
+_refresh_thread = None
+
+
+def refresh(version):
+    # Builds the index of catalog `version` and swaps it in
+    global _index
+    _index = PrefixIndex.build(version)
+
+
+def refresh_in_thread(version):
+    try:
+        refresh(version)
+    except Exception:
+        logger.exception('Autocomplete index rebuild failed')
+    finally:
+        connection.close()
+
+
+def start_refresh(version):
+    global _refresh_thread
+    with _lock:
+        if _refresh_thread is None or not _refresh_thread.is_alive():
+            _refresh_thread = threading.Thread(
+                target=refresh_in_thread, args=(version,), name='autocomplete-refresh', daemon=True)
+            _refresh_thread.start()
+
+
+def get_index():
+    # Once a process has an index, requests never wait for a rebuild: a
+    # new catalog version is built in a background thread while the old
+    # index keeps answering. Only the first request builds it inline
+    version = get_version(CATALOG_VERSION)
+    index = _index
+    if index is None:
+        with _lock:
+            if _index is None:
+                refresh(version)
+        return _index
+    if index.version != version:
+        start_refresh(version)
+    return index
+
+
+def suggest(prefix, limit=10):
+    return get_index().lookup(prefix, min(limit, MAX_RESULTS))
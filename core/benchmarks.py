@@ -0,0 +1,494 @@
+import asyncio
+import copy
+import itertools
+import json
+import time
+from unittest import mock
+
+import stripe
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.signals import request_finished, request_started
+from django.template.loader import render_to_string
+from django.db import close_old_connections, connection, transaction
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from . import payments
+from .tests.fake_stripe import FakeStripe
+from .models import Address, Item, Order, Payment, Refund, WebhookEvent
+
+# Benchmarks for `manage.py benchmark`. Each scenario creates its own data
+# and runs inside a transaction that the command rolls back afterwards.
+SCENARIOS = {}
+
+DUMMY_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def timed(func, repeat):
+    # Returns (mean seconds, queries) of `repeat` calls after one warm-up call.
+    # The command's transaction turns atomic blocks into savepoints, those
+    # statements are not counted
+    func()
+    executed = []
+
+    def count(execute, sql, params, many, context):
+        if 'SAVEPOINT' not in sql:
+            executed.append(sql)
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat, len(executed) / repeat
+
+
+def create_items(count, prefix='bench'):
+    return Item.objects.bulk_create([
+        Item(
+            title=f'Benchmark item {i}',
+            price=10.0 + i,
+            discount_price=(5.0 + i) if i % 3 == 0 else None,
+            category='S',
+            label='P',
+            slug=f'{prefix}-{i}',
+            description=f'Description of benchmark item {i}',
+            image='sample.jpg'
+        ) for i in range(count)
+    ])
+
+
+def anonymous_get(path, **params):
+    request = RequestFactory().get(path, params)
+    request.user = AnonymousUser()
+    request.session = {}
+    request._messages = []
+    return request
+
+
+@scenario('catalog_render')
+def catalog_render(repeat, **kwargs):
+    from .views import HomeView
+
+    create_items(HomeView.paginate_by)
+    view = HomeView.as_view()
+
+    def render():
+        view(anonymous_get('/')).render()
+
+    results = []
+    with override_settings(CACHES=DUMMY_CACHES):
+        results.append(('home.html, no fragment cache',) + timed(render, repeat))
+    caches['default'].clear()
+    results.append(('home.html, cached product cards',) + timed(render, repeat))
+    return results
+
+
+@scenario('anonymous_pages')
+def anonymous_pages(repeat, **kwargs):
+    # Requests per second through the WSGI application for anonymous
+    # catalog and product pages, with and without core.page_cache
+    from ecommerce.wsgi import application
+
+    items = create_items(10)
+    environ = RequestFactory()._base_environ
+
+    def request(path, **headers):
+        response = application(environ(PATH_INFO=path, **headers), lambda status, headers: None)
+        b''.join(response)
+        response.close()
+        return response
+
+    def get(path, **headers):
+        return lambda: request(path, **headers)
+
+    # Like the test client, keep the rolled back transaction's connection
+    # open across requests
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    results = []
+    try:
+        for path in ['/', items[0].get_absolute_url()]:
+            with override_settings(ALLOWED_HOSTS=['testserver'], ANONYMOUS_PAGE_CACHE=False):
+                results.append((f'GET {path}, rendered',) + timed(get(path), repeat))
+
+            caches['default'].clear()
+            with override_settings(ALLOWED_HOSTS=['testserver'], ANONYMOUS_PAGE_CACHE=True):
+                results.append((f'GET {path}, page cache',) + timed(get(path), repeat))
+                etag = request(path)['ETag']
+                results.append((f'GET {path}, If-None-Match',) +
+                               timed(get(path, HTTP_IF_NONE_MATCH=etag), repeat))
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+    return results
+
+
+# CheckoutForm flag: short label
+CHECKOUT_FLAGS = {
+    'use_default_shipping': 'use-ship',
+    'set_default_shipping': 'set-ship',
+    'same_billing_address': 'same',
+    'use_default_billing': 'use-bill',
+    'set_default_billing': 'set-bill',
+}
+
+
+def checkout_address(user, address_type):
+    return Address.objects.create(
+        user=user,
+        first_name='Bench',
+        last_name='Mark',
+        street_address='1 Main Street',
+        apartment_address='',
+        country='DE',
+        zip='10115',
+        address_type=address_type,
+        default=True
+    )
+
+
+@scenario('checkout')
+def checkout(repeat, **kwargs):
+    # CheckoutView.post for every combination of the CheckoutForm flags,
+    # with default addresses on file so every combination succeeds
+    from .views import CheckoutView
+
+    user = get_user_model().objects.create_user('checkout-bench')
+    Order.objects.create(user=user, ordered=False, ordered_date=timezone.now())
+    checkout_address(user, 'S')
+    checkout_address(user, 'B')
+    view = CheckoutView.as_view()
+    form = {'payment_option': 'S'}
+    for prefix in ['shipping', 'billing']:
+        form.update({
+            f'{prefix}_first_name': 'Bench',
+            f'{prefix}_last_name': 'Mark',
+            f'{prefix}_address': '2 Side Street',
+            f'{prefix}_country': 'NL',
+            f'{prefix}_zip': '1011',
+        })
+
+    def post(data):
+        def call():
+            request = RequestFactory().post('/checkout/', data)
+            request.user = user
+            response = view(request)
+            assert response.status_code == 302 and 'payment' in response.url, response.url
+        return call
+
+    results = []
+    for values in itertools.product([False, True], repeat=len(CHECKOUT_FLAGS)):
+        flags = [flag for flag, value in zip(CHECKOUT_FLAGS, values) if value]
+        data = dict(form, **{flag: 'on' for flag in flags})
+        label = ' '.join(CHECKOUT_FLAGS[flag] for flag in flags) or 'new addresses'
+        results.append((f'POST /checkout/ {label}',) + timed(post(data), repeat))
+    return results
+
+
+@scenario('checkout_render')
+def checkout_render(repeat, **kwargs):
+    # checkout.html with the cached country selects of CheckoutForm and with
+    # the stock django_countries form fields they replaced
+    from django_countries.fields import CountryField
+    from django_countries.widgets import CountrySelectWidget
+    from .forms import CheckoutForm, CouponForm
+
+    def stock_country_field():
+        return CountryField(blank_label='Select country').formfield(
+            required=False,
+            widget=CountrySelectWidget(attrs={'class': 'custom-select d-block w-100'}))
+
+    class StockCheckoutForm(CheckoutForm):
+        shipping_country = stock_country_field()
+        billing_country = stock_country_field()
+
+    user = get_user_model().objects.create_user('checkout-render-bench')
+    order = Order.objects.create(user=user, ordered=False, ordered_date=timezone.now())
+    request = RequestFactory().get('/checkout/')
+    request.user = user
+
+    def render(form_class):
+        def call():
+            render_to_string('checkout.html', {
+                'form': form_class(),
+                'order': order,
+                'couponform': CouponForm(),
+                'DISPLAY_COUPON_FORM': True,
+                'user': user,
+            }, request)
+        return call
+
+    return [
+        ('checkout.html, django_countries selects',) + timed(render(StockCheckoutForm), repeat),
+        ('checkout.html, cached country selects',) + timed(render(CheckoutForm), repeat),
+    ]
+
+
+# Round trip of the fake Stripe server in the payment_concurrency scenario
+STRIPE_LATENCY = 0.2
+
+
+@scenario('payment_concurrency')
+def payment_concurrency(repeat, **kwargs):
+    # GET /payment/stripe with a PaymentIntent to create on every request,
+    # against core.tests.fake_stripe answering after STRIPE_LATENCY.
+    # PaymentView holds its thread for the round trip, AsyncPaymentView
+    # awaits it so one event loop serves many requests at once. Reported per
+    # request
+    from . import cart
+    from .views import AsyncPaymentView, PaymentView
+
+    concurrency = [1, 10, 50]
+    create_items(1, prefix='payment-bench')
+    item = Item.objects.get(slug='payment-bench-0')
+    users = []
+    for i in range(max(concurrency)):
+        user = get_user_model().objects.create_user(f'payment-bench-{i}')
+        cart.add_item(user, item)
+        Order.objects.filter(user=user).update(billing_address=checkout_address(user, 'B'))
+        users.append(user)
+
+    def request(user):
+        request = RequestFactory().get('/payment/stripe')
+        request.user = user
+        request._messages = []
+        return request
+
+    def run_sync(users):
+        # Forget the intents so every request calls Stripe
+        Order.objects.filter(user__in=users).update(stripe_intent_id=None)
+        view = PaymentView.as_view()
+        for user in users:
+            view(request(user), payment_option='stripe')
+
+    def run_async(users):
+        Order.objects.filter(user__in=users).update(stripe_intent_id=None)
+        view = AsyncPaymentView.as_view()
+
+        async def gather():
+            await asyncio.gather(*[view(request(user), payment_option='stripe') for user in users])
+        async_to_sync(gather)()
+
+    def per_request(label, func, count):
+        seconds, queries = timed(lambda: func(users[:count]), repeat)
+        return label, seconds / count, queries / count
+
+    async def in_one_loop(label, func, count):
+        # Like a server, keep one event loop and so one Stripe client for
+        # all requests. The ORM work still runs on this thread
+        return await sync_to_async(per_request)(label, func, count)
+
+    results = []
+    with FakeStripe(latency=STRIPE_LATENCY) as fake, \
+            mock.patch.multiple(stripe, api_base=fake.url, api_key='sk_test_fake', max_network_retries=0):
+        results.append(per_request('PaymentView, one thread', run_sync, 10))
+        for count in concurrency:
+            label = f'AsyncPaymentView, {count} concurrent'
+            results.append(async_to_sync(in_one_loop)(label, run_async, count))
+    return results
+
+
+def legacy_finalize_order(order, user_id):
+    # OrderConfirmedView before payments.finalize_order, for comparison
+    payment = Payment(stripe_charge_id=order.stripe_intent_id, user_id=user_id, amount=order.order_total)
+    payment.save()
+    order_items = order.items.all()
+    order_items.update(ordered=True)
+    for item in order_items:
+        item.save()
+    order.ordered = True
+    order.payment = payment
+    order.ref_code = payments.create_ref_code(order.pk)
+    order.save()
+
+
+@scenario('order_finalization')
+def order_finalization(repeat, **kwargs):
+    # Marking a paid order as ordered for growing carts, each call is rolled
+    # back so the same order is finalized again
+    from . import cart
+
+    sizes = [1, 10, 100]
+    create_items(max(sizes), prefix='finalize-bench')
+    items = list(Item.objects.filter(slug__startswith='finalize-bench-').order_by('id'))
+
+    def finalize(func, order, user_id):
+        def call():
+            with transaction.atomic():
+                func(copy.copy(order), user_id)
+                transaction.set_rollback(True)
+        return call
+
+    results = []
+    for size in sizes:
+        user = get_user_model().objects.create_user(f'finalize-bench-{size}')
+        for item in items[:size]:
+            cart.add_item(user, item)
+        Order.objects.filter(user=user).update(stripe_intent_id=f'pi_finalize_bench_{size}')
+        order = Order.objects.get(user=user, ordered=False)
+        amount = payments.order_amount(order)
+
+        def finalize_order(order, user_id):
+            payments.finalize_order(order, user_id, amount)
+
+        for label, func in [('finalize_order', finalize_order),
+                            ('save() per line', legacy_finalize_order)]:
+            results.append((f'{label}, {size} lines',) + timed(finalize(func, order, user.pk), repeat))
+    return results
+
+
+@scenario('webhooks')
+def webhooks_scenario(repeat, **kwargs):
+    # The payment_intent.succeeded webhook request, which only appends to the
+    # inbox, and the worker's batches completing the orders afterwards. Each
+    # batch is rolled back so the same events are processed again
+    from . import cart, payments, webhooks
+    from .tests.fake_stripe import recorded_event, sign_payload
+
+    secret = 'whsec_bench'
+    counter = itertools.count()
+
+    def deliver():
+        event_id = f'evt_webhook_bench_{next(counter)}'
+        payload = json.dumps(recorded_event('payment_intent.succeeded', event_id=event_id))
+        request = RequestFactory().post('/webhooks/stripe/', payload, content_type='application/json',
+                                        HTTP_STRIPE_SIGNATURE=sign_payload(payload, secret))
+        webhooks.stripe_webhook(request)
+
+    def process(size):
+        def call():
+            with transaction.atomic():
+                webhooks.process_batch(size)
+                transaction.set_rollback(True)
+        return call
+
+    sizes = [1, 10, 100]
+    create_items(1, prefix='webhook-bench')
+    item = Item.objects.get(slug='webhook-bench-0')
+    results = []
+    with override_settings(STRIPE_WEBHOOK_SECRET=secret):
+        results.append(('webhook request',) + timed(deliver, repeat))
+
+    for size in sizes:
+        WebhookEvent.objects.filter(processed=None).update(processed=timezone.now())
+        events = []
+        for i in range(size):
+            user = get_user_model().objects.create_user(f'webhook-bench-{size}-{i}')
+            cart.add_item(user, item)
+            intent_id = f'pi_webhook_bench_{size}_{i}'
+            order = Order.objects.get(user=user)
+            amount = payments.order_amount(order)
+            Order.objects.filter(pk=order.pk).update(stripe_intent_id=intent_id, stripe_intent_amount=amount)
+            event = recorded_event('payment_intent.succeeded', event_id=f'evt_{intent_id}',
+                                   id=intent_id, amount=amount)
+            events.append(WebhookEvent(event_id=event['id'], type=event['type'], payload=json.dumps(event)))
+        WebhookEvent.objects.bulk_create(events)
+
+        seconds, queries = timed(process(size), max(1, repeat // size))
+        results.append((f'process_batch, {size} events, per event', seconds / size, queries / size))
+    return results
+
+
+@scenario('refunds')
+def refunds_scenario(repeat, **kwargs):
+    # A run of 100 refunds through core.refunds against core.tests.fake_stripe
+    # answering after 50 ms, for growing thread pools. Reported per refund
+    from . import jobs, refunds
+
+    count = 100
+    refund_rows = []
+    for i in range(count):
+        user = get_user_model().objects.create_user(f'refund-bench-{i}')
+        payment = Payment.objects.create(stripe_charge_id=f'pi_refund_bench_{i}', user=user, amount=20.0)
+        order = Order.objects.create(user=user, ordered=True, ordered_date=timezone.now(),
+                                     payment=payment, ref_code=f'refund-bench-{i}')
+        refund_rows.append(Refund(order=order, reason='Benchmark', email='bench@example.com'))
+    Refund.objects.bulk_create(refund_rows)
+
+    def run(fake):
+        def call():
+            # Forget the refunds of the last call
+            for intent in fake.intents.values():
+                intent.pop('amount_refunded', None)
+            fake.responses.clear()
+            with transaction.atomic():
+                refunds.accept(Refund.objects.all())
+                jobs.run_pending()
+                transaction.set_rollback(True)
+        return call
+
+    results = []
+    with FakeStripe(latency=0.05) as fake, \
+            mock.patch.multiple(stripe, api_base=fake.url, api_key='sk_test_fake', max_network_retries=0):
+        for i in range(count):
+            intent_id = f'pi_refund_bench_{i}'
+            fake.intents[intent_id] = {'id': intent_id, 'amount': 2000, 'currency': 'eur', 'status': 'succeeded'}
+        for threads in [1, 4, 8]:
+            with override_settings(REFUND_THREADS=threads, REFUND_RATE_LIMIT=1000):
+                seconds, queries = timed(run(fake), max(1, repeat // 25))
+            results.append((f'{threads} threads, per refund', seconds / count, queries / count))
+    return results
+
+
+@scenario('bulk_actions')
+def bulk_actions(repeat, orders=1_000_000, **kwargs):
+    # make_delivered on every order of a table of `orders`, as one UPDATE and
+    # in core.bulk chunks of growing size, reported per order. A chunk is the
+    # longest any row stays locked, its own time is reported as well
+    from . import bulk
+    from .models import BulkRun
+
+    user = get_user_model().objects.create_user('bulk-bench')
+    now = timezone.now()
+    Order.objects.bulk_create(
+        (Order(user=user, ordered=True, ordered_date=now, ref_code=f'bulk-bench-{i}') for i in range(orders)),
+        batch_size=10000
+    )
+    selection = Order.objects.with_totals()
+    middle = Order.objects.order_by('pk').values_list('pk', flat=True)[orders // 2]
+
+    def single_update():
+        with transaction.atomic():
+            selection.update(**bulk.ORDER_ACTIONS['make_delivered'])
+            transaction.set_rollback(True)
+
+    def chunked(batch_size):
+        def call():
+            with transaction.atomic(), override_settings(BULK_ACTION_BATCH_SIZE=batch_size,
+                                                         BULK_ACTION_INLINE_LIMIT=orders):
+                bulk.start('make_delivered', selection)
+                transaction.set_rollback(True)
+        return call
+
+    # A run over every order, its chunks taken from the middle
+    stored = BulkRun.objects.create(action='make_delivered', batch_size=10000)
+    bulk.store_selection(stored, selection)
+
+    def one_chunk(batch_size):
+        def call():
+            with transaction.atomic():
+                BulkRun.objects.filter(pk=stored.pk).update(batch_size=batch_size, last_pk=middle)
+                bulk.apply_chunk(BulkRun.objects.get(pk=stored.pk))
+                transaction.set_rollback(True)
+        return call
+
+    passes = max(1, repeat // 50)
+    seconds, queries = timed(single_update, passes)
+    results = [('single UPDATE, per order', seconds / orders, queries / orders)]
+    for batch_size in [1000, 10000]:
+        seconds, queries = timed(chunked(batch_size), passes)
+        results.append((f'chunks of {batch_size}, per order', seconds / orders, queries / orders))
+        results.append((f'one chunk of {batch_size}',) + timed(one_chunk(batch_size), repeat))
+    return results
@@ -0,0 +1,120 @@
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import jobs
+from .models import BulkRun, BulkRunOrder, Order, JOB_DONE, JOB_QUEUED, JOB_RUNNING
+
+# Order status changes from the admin, applied in chunks of
+# BULK_ACTION_BATCH_SIZE orders so no statement locks more than a chunk of
+# rows. The selected orders are stored as BulkRunOrder rows when the run
+# starts, so orders created later are left out and chunks are read from
+# that index rather than from the admin queryset. Selections of up to
+# BULK_ACTION_INLINE_LIMIT orders are changed within the request, larger
+# ones by a job. A chunk's rows are deleted and the BulkRun's last_pk moves
+# in the same transaction as the chunk, so an interrupted run resumes right
+# after the last chunk it finished.
+RUN_CHUNKS = 'run_bulk_action'
+
+# Admin action: the fields it sets on the selected orders
+ORDER_ACTIONS = {
+    'make_delivered': {'being_delivered': True},
+    'make_received': {'received': True, 'being_delivered': False},
+    # refund_granted is set by core.refunds once a refund went through
+    'make_refund_accepted': {'refund_requested': False},
+}
+
+
+def store_selection(run, queryset):
+    # Stores the primary keys of the orders of `queryset` with the run,
+    # returns how many there were. One INSERT ... SELECT: the selection is
+    # read once, the GROUP BY of OrderQuerySet.with_totals on admin querysets
+    # included, and no row goes through Python
+    sql, params = queryset.order_by().values('pk').distinct().query.sql_with_params()
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {qn(BulkRunOrder._meta.db_table)} ({qn("run_id")}, {qn("order_id")}) '
+            f'SELECT %s, {qn("id")} FROM ({sql}) selection',
+            [run.pk, *params]
+        )
+        return cursor.rowcount
+
+
+def next_chunk(run):
+    return list(run.orders.filter(order_id__gt=run.last_pk).order_by('order_id').values_list(
+        'order_id', flat=True)[:run.batch_size])
+
+
+def apply_chunk(run):
+    # Changes the next chunk of orders and moves the run past it, returns
+    # False once the run is finished
+    pks = next_chunk(run)
+    if pks:
+        fields = {'last_pk': pks[-1], 'done': F('done') + len(pks)}
+    else:
+        fields = {'status': JOB_DONE, 'finished': timezone.now()}
+
+    with transaction.atomic():
+        if pks:
+            Order.objects.filter(pk__in=pks).update(**ORDER_ACTIONS[run.action])
+            run.orders.filter(order_id__gt=run.last_pk, order_id__lte=pks[-1]).delete()
+        if not BulkRun.objects.filter(pk=run.pk, last_pk=run.last_pk).update(**fields):
+            # Another worker resuming the run got there first
+            transaction.set_rollback(True)
+            return False
+
+    if not pks:
+        run.status = JOB_DONE
+        return False
+    run.last_pk = pks[-1]
+    run.done += len(pks)
+    return True
+
+
+def start(action, queryset):
+    # Applies ORDER_ACTIONS[action] to the orders of `queryset`, returns the
+    # BulkRun. It is done already unless the selection was handed to a job
+    with transaction.atomic():
+        run = BulkRun.objects.create(action=action, batch_size=settings.BULK_ACTION_BATCH_SIZE)
+        run.total = store_selection(run, queryset)
+        if run.total > settings.BULK_ACTION_INLINE_LIMIT:
+            BulkRun.objects.filter(pk=run.pk).update(total=run.total)
+            resume(run)
+            return run
+        run.status = JOB_RUNNING
+        BulkRun.objects.filter(pk=run.pk).update(total=run.total, status=run.status)
+
+    while apply_chunk(run):
+        pass
+    return run
+
+
+def resume(run):
+    # Continues an unfinished run from a job, unless one is queued or running
+    # already. Returns whether it queued one
+    if jobs.active(RUN_CHUNKS, run_id=run.pk):
+        return False
+    jobs.enqueue(RUN_CHUNKS, {'run_id': run.pk})
+    return True
+
+
+@jobs.task(RUN_CHUNKS)
+def run_chunks(run_id):
+    # Applies chunks for up to BULK_ACTION_JOB_SECONDS, then leaves the rest
+    # to a new job
+    run = BulkRun.objects.get(pk=run_id)
+    if run.status == JOB_DONE:
+        return
+    if run.status == JOB_QUEUED:
+        run.status = JOB_RUNNING
+        BulkRun.objects.filter(pk=run.pk).update(status=run.status)
+
+    deadline = time.monotonic() + settings.BULK_ACTION_JOB_SECONDS
+    while apply_chunk(run):
+        if time.monotonic() > deadline:
+            jobs.enqueue(RUN_CHUNKS, {'run_id': run.pk}, key=f'bulk-{run.pk}-after-{run.last_pk}')
+            return
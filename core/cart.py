@@ -0,0 +1,144 @@
+import functools
+import random
+import time
+
+from django.core.cache import cache
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Order, OrderItem
+from .versions import bump_version, get_version
+
+# Outcomes of a cart mutation, mapped to user messages by the views
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+NOT_IN_CART = 'not_in_cart'
+NO_ORDER = 'no_order'
+
+# The navbar badge count is cached per user under a per-user version. Cart
+# mutations bump the version once they commit and the next page view reads
+# the count again. A count read before the commit is stored under the old
+# version, where nobody looks any more, however late it lands
+ITEM_COUNT_TIMEOUT = 60 * 60
+
+
+# SQLite answers a write that would wait on another connection's
+# transaction with "database is locked" instead of queueing it. Mutations
+# outside a transaction start again from the top, up to LOCK_RETRIES times;
+# the unique open order constraint keeps the retried creates to one order
+LOCK_RETRIES = 10
+LOCK_RETRY_DELAY = 0.01
+
+
+def retry_when_locked(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, LOCK_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if ('locked' not in str(e) or attempt == LOCK_RETRIES or
+                        connection.in_atomic_block):
+                    raise
+            time.sleep(random.uniform(0, LOCK_RETRY_DELAY * 2 ** attempt))
+    return wrapper
+
+
+def item_count_key(user_id):
+    return f'cart:item-count:{user_id}:{get_version(f"cart:{user_id}")}'
+
+
+def get_item_count(user):
+    key = item_count_key(user.pk)
+    count = cache.get(key)
+    if count is None:
+        count = Order.objects.filter(
+            user=user,
+            ordered=False
+        ).values_list('line_count', flat=True).first() or 0
+        cache.set(key, count, ITEM_COUNT_TIMEOUT)
+    return count
+
+
+def forget_item_count(user_id):
+    transaction.on_commit(lambda: bump_version(f'cart:{user_id}'))
+
+
+def open_orders(user):
+    # Lock the open order row for the rest of the transaction so concurrent
+    # mutations of the same cart are serialised (a no-op on SQLite)
+    return Order.objects.select_for_update(of=('self',)).select_related('coupon').filter(
+        user=user,
+        ordered=False
+    )
+
+
+def cart_items(order, item):
+    return OrderItem.objects.filter(
+        user=order.user_id,
+        item=item,
+        ordered=False,
+        order=order
+    )
+
+
+@retry_when_locked
+def add_item(user, item):
+    with transaction.atomic():
+        # The unique open order constraint makes concurrent creates collapse
+        # into a single order, get_or_create re-reads it on IntegrityError
+        order, created = open_orders(user).get_or_create(
+            user=user,
+            ordered=False,
+            defaults={'ordered_date': timezone.now()}
+        )
+
+        if not created and cart_items(order, item).update(quantity=F('quantity') + 1):
+            order.apply_item_delta(item, 1)
+            forget_item_count(user.pk)
+            return UPDATED
+
+        order_item = OrderItem.objects.create(user=user, item=item, ordered=False)
+        Order.items.through.objects.create(order=order, orderitem=order_item)
+        order.apply_item_delta(item, 1, lines=1)
+        forget_item_count(user.pk)
+        return ADDED
+
+
+@retry_when_locked
+def remove_item(user, item):
+    with transaction.atomic():
+        order = open_orders(user).first()
+        if order is None:
+            return NO_ORDER
+
+        order_item = cart_items(order, item).first()
+        if order_item is None:
+            return NOT_IN_CART
+
+        order_item.delete()
+        order.rebuild_totals()
+        forget_item_count(user.pk)
+        return REMOVED
+
+
+@retry_when_locked
+def remove_single_item(user, item):
+    with transaction.atomic():
+        order = open_orders(user).first()
+        if order is None:
+            return NO_ORDER
+
+        if cart_items(order, item).filter(quantity__gt=1).update(quantity=F('quantity') - 1):
+            order.rebuild_totals()
+            return UPDATED
+
+        # Last unit of the line, drop it from the cart entirely
+        if not cart_items(order, item).delete()[0]:
+            return NOT_IN_CART
+
+        order.rebuild_totals()
+        forget_item_count(user.pk)
+        return UPDATED
@@ -0,0 +1,172 @@
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import Address, UserProfile
+
+# Checkout address handling. The submission is validated and the default
+# addresses are read before anything is written, the writes then happen in
+# one transaction: at most one UPDATE clearing old default flags, one INSERT
+# of the new addresses, one UPDATE of the profile's default pointers and one
+# UPDATE of the order.
+SHIPPING = 'S'
+BILLING = 'B'
+
+# address_type: UserProfile pointer to the default address of that type
+PROFILE_FIELDS = {
+    SHIPPING: 'default_shipping_address',
+    BILLING: 'default_billing_address',
+}
+
+# The default addresses are cached per user, a cold miss costs one query
+DEFAULT_ADDRESSES_TIMEOUT = 60 * 60
+
+# Validation failures, mapped to user messages by CheckoutView
+NO_DEFAULT_SHIPPING = 'no_default_shipping'
+NO_DEFAULT_BILLING = 'no_default_billing'
+INCOMPLETE_SHIPPING = 'incomplete_shipping'
+INCOMPLETE_BILLING = 'incomplete_billing'
+
+# Address field: CheckoutForm field suffix
+ADDRESS_FIELDS = {
+    'first_name': 'first_name',
+    'last_name': 'last_name',
+    'street_address': 'address',
+    'apartment_address': 'address2',
+    'country': 'country',
+    'zip': 'zip',
+}
+REQUIRED_FIELDS = ['first_name', 'last_name', 'street_address', 'country', 'zip']
+
+
+def default_addresses_key(user_id):
+    return f'checkout:default-addresses:{user_id}'
+
+
+def default_addresses(user_id):
+    # {address_type: address} for the addresses the user's profile points to
+    defaults = cache.get(default_addresses_key(user_id))
+    if defaults is None:
+        profile = UserProfile.objects.select_related(
+            *PROFILE_FIELDS.values()
+        ).filter(user=user_id).first()
+        defaults = {}
+        for address_type, field in PROFILE_FIELDS.items():
+            address = getattr(profile, field, None)
+            if address is not None:
+                defaults[address_type] = address
+        cache.set(default_addresses_key(user_id), defaults, DEFAULT_ADDRESSES_TIMEOUT)
+    return defaults
+
+
+def forget_default_addresses(user_id):
+    # Again once committed, in case a concurrent request cached the old ones
+    key = default_addresses_key(user_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def address_from_form(user_id, data, prefix, address_type):
+    values = {field: data.get(f'{prefix}_{name}') or '' for field, name in ADDRESS_FIELDS.items()}
+    if not all(values[field] for field in REQUIRED_FIELDS):
+        return None
+    return Address(user_id=user_id, address_type=address_type, **values)
+
+
+def copy_address(address, address_type):
+    return Address(
+        user_id=address.user_id,
+        address_type=address_type,
+        **{field: getattr(address, field) for field in ADDRESS_FIELDS}
+    )
+
+
+def resolve_addresses(user_id, data):
+    # Returns (error, shipping, billing), the addresses may be unsaved
+    same_billing = data.get('same_billing_address')
+    use_default_shipping = data.get('use_default_shipping')
+    use_default_billing = data.get('use_default_billing') and not same_billing
+
+    defaults = {}
+    if use_default_shipping or use_default_billing:
+        defaults = default_addresses(user_id)
+
+    if use_default_shipping:
+        shipping = defaults.get(SHIPPING)
+        if shipping is None:
+            return NO_DEFAULT_SHIPPING, None, None
+    else:
+        shipping = address_from_form(user_id, data, 'shipping', SHIPPING)
+        if shipping is None:
+            return INCOMPLETE_SHIPPING, None, None
+        shipping.default = bool(data.get('set_default_shipping'))
+
+    if same_billing:
+        billing = copy_address(shipping, BILLING)
+        billing.default = bool(data.get('set_default_billing'))
+    elif use_default_billing:
+        billing = defaults.get(BILLING)
+        if billing is None:
+            return NO_DEFAULT_BILLING, None, None
+    else:
+        billing = address_from_form(user_id, data, 'billing', BILLING)
+        if billing is None:
+            return INCOMPLETE_BILLING, None, None
+        billing.default = bool(data.get('set_default_billing'))
+
+    return None, shipping, billing
+
+
+def create_addresses(addresses):
+    # bulk_create only sets primary keys where the backend returns them from
+    # a multi-row INSERT (PostgreSQL), elsewhere insert one at a time
+    if connection.features.can_return_rows_from_bulk_insert:
+        Address.objects.bulk_create(addresses)
+    else:
+        for address in addresses:
+            address.save(force_insert=True)
+
+
+def set_addresses(order, data):
+    # Assigns the shipping and billing addresses of a valid CheckoutForm's
+    # cleaned_data to the order, returns an error constant or None
+    error, shipping, billing = resolve_addresses(order.user_id, data)
+    if error:
+        return error
+
+    new_addresses = [address for address in (shipping, billing) if address.pk is None]
+    new_defaults = [address for address in new_addresses if address.default]
+    with transaction.atomic():
+        if new_defaults:
+            Address.objects.filter(
+                user=order.user_id,
+                address_type__in=[address.address_type for address in new_defaults],
+                default=True
+            ).update(default=False)
+        if new_addresses:
+            create_addresses(new_addresses)
+        if new_defaults:
+            UserProfile.objects.filter(user=order.user_id).update(**{
+                PROFILE_FIELDS[address.address_type]: address for address in new_defaults
+            })
+            forget_default_addresses(order.user_id)
+
+        order.shipping_address = shipping
+        order.billing_address = billing
+        order.save(update_fields=['shipping_address', 'billing_address'])
+    return None
+
+
+def address_changed_receiver(sender, instance, *args, **kwargs):
+    # Admin edits and deletes. The profile pointers are only moved to an
+    # address by checkout and the backfill_default_addresses command, but
+    # one that stops being the default of its type loses them here
+    if kwargs.get('signal') is post_save and not kwargs.get('created'):
+        for address_type, field in PROFILE_FIELDS.items():
+            if not instance.default or instance.address_type != address_type:
+                UserProfile.objects.filter(**{field: instance.pk}).update(**{field: None})
+    forget_default_addresses(instance.user_id)
+
+
+post_save.connect(address_changed_receiver, sender=Address)
+post_delete.connect(address_changed_receiver, sender=Address)
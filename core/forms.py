@@ -1,5 +1,10 @@
+import re
+
 from django import forms
-from django_countries.fields import CountryField
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+from django_countries import countries
 from django_countries.widgets import CountrySelectWidget
 from allauth.account.forms import SignupForm
 
@@ -8,14 +13,50 @@ PAYMENT_CHOICES = (
     ('P', 'PayPal')
 )
 
+# Translating and sorting the ~250 country names is the bulk of rendering
+# and validating CheckoutForm, so both happen once per language
+_country_choices = {}
+
+
+def country_choices():
+    language = get_language()
+    if language not in _country_choices:
+        _country_choices[language] = [('', 'Select country')] + list(countries)
+    return _country_choices[language]
+
+
+class CachedSelect(forms.Select):
+    # Renders the <select> once per language, name and attributes, each
+    # render only marks the selected option. For choices that depend on
+    # nothing but the language
+    rendered = {}
+    selected = re.compile(r'(<option value="[^"]*") selected>')
+
+    def render(self, name, value, attrs=None, renderer=None):
+        key = (get_language(), name, tuple(sorted(self.build_attrs(self.attrs, attrs).items())))
+        html = self.rendered.get(key)
+        if html is None:
+            html = self.selected.sub(r'\1>', super().render(name, None, attrs, renderer))
+            self.rendered[key] = html
+
+        option = f'<option value="{escape(self.format_value(value)[0])}">'
+        return mark_safe(html.replace(option, option[:-1] + ' selected>', 1))
+
+
+class CachedCountrySelectWidget(CountrySelectWidget, CachedSelect):
+    # django_countries' flag image around a CachedSelect
+    pass
+
+
 class CheckoutForm(forms.Form):
     shipping_first_name = forms.CharField(required=False)
     shipping_last_name = forms.CharField(required=False)
     shipping_address = forms.CharField(required=False)
     shipping_address2 = forms.CharField(required=False)
-    shipping_country = CountryField(blank_label='Select country').formfield(
+    shipping_country = forms.ChoiceField(
         required=False,
-        widget=CountrySelectWidget(attrs={
+        choices=country_choices,
+        widget=CachedCountrySelectWidget(attrs={
             'class': 'custom-select d-block w-100',
         }))
     shipping_zip = forms.CharField(required=False)
@@ -24,9 +65,10 @@ class CheckoutForm(forms.Form):
     billing_last_name = forms.CharField(required=False)
     billing_address = forms.CharField(required=False)
     billing_address2 = forms.CharField(required=False)
-    billing_country = CountryField(blank_label='Select country').formfield(
+    billing_country = forms.ChoiceField(
         required=False,
-        widget=CountrySelectWidget(attrs={
+        choices=country_choices,
+        widget=CachedCountrySelectWidget(attrs={
             'class': 'custom-select d-block w-100',
         }))
     billing_zip = forms.CharField(required=False)
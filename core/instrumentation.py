@@ -0,0 +1,67 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.template.backends.django import DjangoTemplates, Template
+
+# Per-request timings collected by core.middleware.RequestTimingMiddleware.
+# Outside a sampled request `current` is None and every hook is a no-op.
+current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self, track_queries=True):
+        self.track_queries = track_queries
+        self.start = time.perf_counter()
+        self.query_count = 0
+        self.query_time = 0.0
+        self.queries = Counter()
+        self.timers = Counter()
+
+    def duplicates(self, threshold):
+        # Statements repeated with different parameters, the N+1 signature
+        return {sql: count for sql, count in self.queries.items() if count >= threshold}
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_time += time.perf_counter() - start
+            self.query_count += 1
+            self.queries[sql] += 1
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+@contextmanager
+def timer(name):
+    # Adds the time spent in the block to the current request's `name` timer
+    metrics = current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timers[name] += time.perf_counter() - start
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        with timer('template'):
+            return super().render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    # Times top level template renders, {% include %} runs inside them
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
@@ -0,0 +1,83 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.http import Http404
+
+from .metrics import ITEM_CACHE_LOOKUPS
+from .models import Item, CATALOG_VERSION
+from .versions import get_version
+
+# Read-through cache for Item lookups: a small in-process LRU in front of
+# Django's cache framework. Keys carry the catalog version, so an Item save
+# or delete (which bumps it) retires every cached entry at once.
+LOCAL_CACHE_SIZE = 1024
+LOCAL_CACHE_TTL = 60
+SHARED_CACHE_TIMEOUT = 60 * 60
+
+
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_cache = LRUCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+
+
+def get_item(**lookup):
+    # Lookup by exactly one of slug= or pk=, returns None if there is no such item
+    (field, value), = lookup.items()
+    key = f'item:{get_version(CATALOG_VERSION)}:{field}:{value}'
+
+    item = local_cache.get(key)
+    if item is not None:
+        ITEM_CACHE_LOOKUPS.labels(result='local').inc()
+        return copy.copy(item)
+
+    item = cache.get(key)
+    if item is not None:
+        ITEM_CACHE_LOOKUPS.labels(result='shared').inc()
+    else:
+        ITEM_CACHE_LOOKUPS.labels(result='miss').inc()
+        item = Item.objects.filter(**lookup).first()
+        if item is None:
+            return None
+        cache.set(key, item, SHARED_CACHE_TIMEOUT)
+
+    local_cache.set(key, item)
+    return copy.copy(item)
+
+
+def get_item_or_404(**lookup):
+    item = get_item(**lookup)
+    if item is None:
+        raise Http404('No item matches the given query.')
+    return item
@@ -0,0 +1,205 @@
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import mail_admins
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job, JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+
+# A job queue kept in the database, so side effects leave the request path
+# without a broker. enqueue() inserts a Job in the caller's transaction,
+# workers (manage.py runworker) claim due jobs, call the task registered
+# under the job's name with its payload and retry failures with exponential
+# backoff until max_attempts. Tasks may run more than once, after a retry or
+# a worker crash, and should be idempotent.
+TASKS = {}
+
+# Seconds between claims at most while the database fails
+CLAIM_MAX_BACKOFF = 60
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownTask(Exception):
+    pass
+
+
+def task(name):
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(name, payload=None, key=None, delay=0, max_attempts=None):
+    # Returns the new Job, or the existing one enqueued with the same `key`.
+    # The payload must be JSON serializable, it is passed as keyword arguments
+    if name not in TASKS:
+        raise UnknownTask(name)
+    job = Job(
+        name=name,
+        payload=payload or {},
+        idempotency_key=key,
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+        run_at=timezone.now() + timedelta(seconds=delay)
+    )
+    if key is None:
+        job.save(force_insert=True)
+        return job
+    try:
+        with transaction.atomic():
+            job.save(force_insert=True)
+    except IntegrityError:
+        return Job.objects.get(idempotency_key=key)
+    return job
+
+
+def active(name, **payload):
+    # Whether a `name` job with these payload values is queued or running.
+    # Running jobs of a crashed worker count too, they run again once their
+    # lease runs out
+    lookups = {f'payload__{key}': value for key, value in payload.items()}
+    return Job.objects.filter(name=name, status__in=[JOB_QUEUED, JOB_RUNNING], **lookups).exists()
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def due_jobs(now):
+    # Queued jobs whose time has come, and running ones whose worker let its
+    # lease run out
+    return Job.objects.filter(
+        Q(status=JOB_QUEUED, run_at__lte=now) | Q(status=JOB_RUNNING, locked_until__lt=now))
+
+
+def claim(limit, worker=None):
+    # Locks up to `limit` due jobs for this worker. The UPDATE re-checks that
+    # they are still due, so of two workers selecting the same job only one
+    # gets it, on every backend
+    now = timezone.now()
+    ids = list(due_jobs(now).order_by('run_at', 'pk').values_list('pk', flat=True)[:limit])
+    if not ids:
+        return []
+
+    token = f'{worker or worker_name()}:{uuid.uuid4().hex[:8]}'
+    due_jobs(now).filter(pk__in=ids).update(
+        status=JOB_RUNNING,
+        locked_by=token,
+        locked_until=now + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+        attempts=F('attempts') + 1
+    )
+    return list(Job.objects.filter(locked_by=token, status=JOB_RUNNING).order_by('run_at', 'pk'))
+
+
+def retry_delay(attempts):
+    # Seconds before attempt `attempts + 1`: doubling from JOB_RETRY_DELAY up
+    # to JOB_RETRY_MAX_DELAY, jittered so failures do not retry in lockstep
+    delay = min(settings.JOB_RETRY_DELAY * 2 ** (attempts - 1), settings.JOB_RETRY_MAX_DELAY)
+    return random.uniform(delay / 2, delay)
+
+
+def finish(job, **fields):
+    # A worker that lost its lease to another leaves the job alone
+    Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+        locked_by=None, locked_until=None, **fields)
+    for field, value in fields.items():
+        setattr(job, field, value)
+
+
+def run_job(job):
+    # Runs a claimed job and records the outcome, returns True on success
+    try:
+        if job.attempts > job.max_attempts:
+            # Its last attempt's worker crashed
+            raise RuntimeError(f'Lease expired on attempt {job.max_attempts}')
+        if job.name not in TASKS:
+            raise UnknownTask(job.name)
+        TASKS[job.name](**job.payload)
+    except Exception:
+        logger.exception('Job %s failed', job)
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            finish(job, status=JOB_FAILED, last_error=error, finished=timezone.now())
+        else:
+            run_at = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+            finish(job, status=JOB_QUEUED, last_error=error, run_at=run_at)
+        return False
+
+    finish(job, status=JOB_DONE, finished=timezone.now())
+    return True
+
+
+def run_pending(batch_size=100):
+    # Runs due jobs in the calling thread until there are none, returns how
+    # many ran
+    count = 0
+    while True:
+        jobs = claim(batch_size)
+        if not jobs:
+            return count
+        for job in jobs:
+            run_job(job)
+        count += len(jobs)
+
+
+def run_in_thread(job):
+    close_old_connections()
+    try:
+        run_job(job)
+    except Exception:
+        # Recording the outcome failed, the job runs again once its lease
+        # expires
+        logger.exception('Job %s could not be recorded', job)
+    finally:
+        close_old_connections()
+
+
+def work(threads, poll_interval=1.0, once=False, stop=None):
+    # Runs jobs on a pool of `threads` threads, claiming as many as there are
+    # idle threads. Stops when `stop` is set or, with `once`, when the queue
+    # is empty; jobs already started are finished first
+    stop = stop or threading.Event()
+    running = set()
+    failures = 0
+    with ThreadPoolExecutor(threads, thread_name_prefix='job') as pool:
+        while not stop.is_set():
+            running = {future for future in running if not future.done()}
+            idle = threads - len(running)
+            try:
+                jobs = claim(idle) if idle else []
+            except Exception:
+                # E.g. the database restarted: reconnect after a pause,
+                # doubling while it stays unreachable
+                failures += 1
+                logger.exception('Claiming jobs failed')
+                connection.close()
+                stop.wait(min(poll_interval * 2 ** (failures - 1), CLAIM_MAX_BACKOFF))
+                continue
+            failures = 0
+            for job in jobs:
+                running.add(pool.submit(run_in_thread, job))
+            if jobs:
+                continue
+
+            if running:
+                wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            elif once:
+                break
+            else:
+                stop.wait(poll_interval)
+
+
+@task('mail_admins')
+def mail_admins_task(subject, message):
+    mail_admins(subject, message)
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core.checkout import PROFILE_FIELDS, forget_default_addresses
+from core.models import Address, UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Points UserProfile default addresses at the newest default=True address of each type'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Profiles updated per query')
+
+    def handle(self, *args, **kwargs):
+        # {user_id: {profile field: address id}}, newer defaults win
+        pointers = {}
+        defaults = Address.objects.filter(default=True).order_by('user', 'id')
+        for user_id, address_type, address_id in defaults.values_list('user', 'address_type', 'id'):
+            pointers.setdefault(user_id, {})[PROFILE_FIELDS[address_type]] = address_id
+
+        fields = list(PROFILE_FIELDS.values())
+        profiles = []
+        for profile in UserProfile.objects.only('user', *fields).order_by('pk').iterator():
+            wanted = pointers.get(profile.user_id, {})
+            stale = False
+            for field in fields:
+                if getattr(profile, f'{field}_id') != wanted.get(field):
+                    setattr(profile, f'{field}_id', wanted.get(field))
+                    stale = True
+            if stale:
+                profiles.append(profile)
+
+        with transaction.atomic():
+            UserProfile.objects.bulk_update(profiles, fields, batch_size=kwargs['batch_size'])
+            for profile in profiles:
+                forget_default_addresses(profile.user_id)
+
+        self.stdout.write(self.style.SUCCESS(f'{len(profiles)} profiles updated'))
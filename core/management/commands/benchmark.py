@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from core.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = 'Runs performance benchmarks, all data they create is rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*',
+                            help=f'Scenarios to run (default: all of {", ".join(SCENARIOS)})')
+        parser.add_argument('--repeat', type=int, default=50,
+                            help='Timed iterations per measurement')
+
+    def handle(self, *args, **kwargs):
+        names = kwargs['scenarios'] or list(SCENARIOS)
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+
+        for name in names:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            with transaction.atomic():
+                results = SCENARIOS[name](repeat=kwargs['repeat'])
+                transaction.set_rollback(True)
+
+            for label, seconds, queries in results:
+                self.stdout.write(f'  {label:<50} {seconds * 1000:9.3f} ms '
+                                  f'{1 / seconds:9.0f} /s {queries:7.1f} queries')
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Order, ORDER_TOTAL_FIELDS
+
+
+class Command(BaseCommand):
+    help = 'Verifies the stored cart totals of open orders and rebuilds them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report mismatching orders, do not rebuild')
+        parser.add_argument('--all', action='store_true',
+                            help='Include orders that have already been ordered')
+
+    def handle(self, *args, **kwargs):
+        orders = Order.objects.select_related('coupon').order_by('pk')
+        if not kwargs['all']:
+            orders = orders.filter(ordered=False)
+
+        mismatched = 0
+        for order in orders.iterator():
+            expected = order.compute_totals()
+            stale = [field for field in ORDER_TOTAL_FIELDS
+                     if round(getattr(order, field), 2) != round(expected[field], 2)]
+            if not stale:
+                continue
+
+            mismatched += 1
+            self.stdout.write(f'Order {order.pk}: stale {", ".join(stale)}')
+            if not kwargs['check']:
+                order.update_totals()
+
+        if kwargs['check'] and mismatched:
+            raise CommandError(f'{mismatched} orders have stale totals')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{mismatched} orders {"need rebuilding" if kwargs["check"] else "rebuilt"}'))
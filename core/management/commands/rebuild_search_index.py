@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from core import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index over all items'
+
+    def handle(self, *args, **kwargs):
+        search.create_index()
+        count = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} items'))
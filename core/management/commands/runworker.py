@@ -0,0 +1,35 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core import jobs
+
+
+class Command(BaseCommand):
+    help = ('Runs background jobs from core.jobs. Several workers, on one or more '
+            'machines, can share the queue')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=settings.JOB_WORKER_THREADS,
+                            help='Jobs run at the same time')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds between looks at an empty queue')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+
+    def handle(self, *args, **kwargs):
+        stop = threading.Event()
+
+        def shutdown(signum, frame):
+            self.stdout.write('Finishing running jobs')
+            stop.set()
+
+        handlers = {signum: signal.signal(signum, shutdown)
+                    for signum in (signal.SIGINT, signal.SIGTERM)}
+        self.stdout.write(f'Worker {jobs.worker_name()} running {kwargs["threads"]} threads')
+        try:
+            jobs.work(kwargs['threads'], kwargs['poll_interval'], once=kwargs['once'], stop=stop)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
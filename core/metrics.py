@@ -0,0 +1,89 @@
+import hmac
+import os
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from .models import Order
+
+# Prometheus metrics. With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR
+# to an empty directory before start up; every worker then writes its values
+# to mmap'd files there which /metrics aggregates. Call
+# prometheus_client.multiprocess.mark_process_dead(worker.pid) from the
+# gunicorn child_exit hook.
+
+REQUEST_LATENCY = Histogram(
+    'ecommerce_request_latency_seconds',
+    'Request latency by URL name',
+    ['url_name', 'method'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+CART_OPERATIONS = Counter(
+    'ecommerce_cart_operations_total',
+    'Cart mutations by operation and outcome',
+    ['operation', 'result']
+)
+COUPON_APPLICATIONS = Counter(
+    'ecommerce_coupon_applications_total',
+    'Coupon codes submitted, by outcome',
+    ['result']
+)
+CHECKOUT_SUBMISSIONS = Counter(
+    'ecommerce_checkout_submissions_total',
+    'Checkout form submissions'
+)
+PAYMENT_INTENTS = Counter(
+    'ecommerce_payment_intents_total',
+    'Stripe PaymentIntent creates, by outcome or Stripe error class',
+    ['result']
+)
+PAYMENT_ERRORS = Counter(
+    'ecommerce_payment_errors_total',
+    'Failed order confirmations by error class',
+    ['error']
+)
+ITEM_CACHE_LOOKUPS = Counter(
+    'ecommerce_item_cache_lookups_total',
+    'core.item_cache lookups by where they were answered: local, shared or miss',
+    ['result']
+)
+
+
+class OpenCartsCollector:
+    # Read at scrape time, so it is correct across all worker processes
+    def collect(self):
+        gauge = GaugeMetricFamily('ecommerce_open_carts', 'Orders not yet ordered')
+        gauge.add_metric([], Order.objects.filter(ordered=False).count())
+        yield gauge
+
+
+class ProcessCollector:
+    # The metrics of this process only, used without PROMETHEUS_MULTIPROC_DIR
+    def collect(self):
+        return REGISTRY.collect()
+
+
+def scrape_registry():
+    registry = CollectorRegistry()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        MultiProcessCollector(registry)
+    else:
+        registry.register(ProcessCollector())
+    registry.register(OpenCartsCollector())
+    return registry
+
+
+def metrics_view(request):
+    # Not served at all without METRICS_TOKEN, the open carts gauge queries
+    # the database on every scrape
+    token = settings.METRICS_TOKEN
+    if not token:
+        raise Http404('Metrics are not configured')
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(scrape_registry()), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+from . import metrics, profiling
+from .instrumentation import RequestMetrics, current
+
+logger = logging.getLogger('core.requests')
+
+# A statement executed this often in one request is reported as duplicated
+DUPLICATE_QUERY_THRESHOLD = 3
+
+
+class RequestTimingMiddleware(MiddlewareMixin):
+    # Records SQL count and time, duplicated statements, template and Stripe
+    # time for a sample of requests and reports them in a Server-Timing
+    # header for staff users and, with REQUEST_TIMING_LOG, as one JSON log
+    # line per request. Under ASGI the queries run on sync_to_async's thread,
+    # where they can't be told apart per request, so only the timers are
+    # reported
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if random.random() >= settings.REQUEST_TIMING_SAMPLE_RATE:
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics.record_query))
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.report(request, response, metrics, self.show_header(request))
+
+    async def __acall__(self, request):
+        if random.random() >= settings.REQUEST_TIMING_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        metrics = RequestMetrics(track_queries=False)
+        token = current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        show_header = await sync_to_async(self.show_header)(request)
+        return self.report(request, response, metrics, show_header)
+
+    def show_header(self, request):
+        # Query counts and timings are for the team, not for every visitor
+        user = getattr(request, 'user', None)
+        return user is not None and user.is_staff
+
+    def report(self, request, response, metrics, show_header):
+        if show_header:
+            response['Server-Timing'] = self.server_timing(metrics)
+        if settings.REQUEST_TIMING_LOG:
+            self.log(request, response, metrics)
+        return response
+
+    def server_timing(self, metrics):
+        entries = []
+        if metrics.track_queries:
+            duplicates = sum(metrics.duplicates(DUPLICATE_QUERY_THRESHOLD).values())
+            entries.append(
+                f'db;dur={metrics.query_time * 1000:.1f};desc="{metrics.query_count} queries, '
+                f'{duplicates} duplicated"'
+            )
+        for name, seconds in sorted(metrics.timers.items()):
+            entries.append(f'{name};dur={seconds * 1000:.1f}')
+        entries.append(f'total;dur={metrics.elapsed * 1000:.1f}')
+        return ', '.join(entries)
+
+    def log(self, request, response, metrics):
+        match = getattr(request, 'resolver_match', None)
+        logger.info(json.dumps({
+            'url_name': match.view_name if match else None,
+            'method': request.method,
+            'status': response.status_code,
+            'total_ms': round(metrics.elapsed * 1000, 2),
+            'db_ms': round(metrics.query_time * 1000, 2) if metrics.track_queries else None,
+            'queries': metrics.query_count if metrics.track_queries else None,
+            'duplicates': metrics.duplicates(DUPLICATE_QUERY_THRESHOLD),
+            'timers_ms': {name: round(seconds * 1000, 2) for name, seconds in metrics.timers.items()},
+        }))
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    # Runs selected views under cProfile, see core.profiling. Listed last in
+    # MIDDLEWARE so the CSRF and auth checks have already run. Async views
+    # are not profiled, cProfile only sees the thread it runs in
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if asyncio.iscoroutinefunction(view_func) or not profiling.should_profile(request):
+            return None
+
+        def call_view():
+            response = view_func(request, *view_args, **view_kwargs)
+            # Template responses render lazily, include that in the profile
+            if hasattr(response, 'render'):
+                response = response.render()
+            return response
+
+        return profiling.profile_call(profiling.view_label(view_func, request.method), call_view)
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    # Feeds REQUEST_LATENCY, labelled with the resolved URL name
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, start)
+        return response
+
+    def observe(self, request, start):
+        match = getattr(request, 'resolver_match', None)
+        metrics.REQUEST_LATENCY.labels(
+            url_name=match.view_name if match else 'unresolved',
+            method=request.method
+        ).observe(time.perf_counter() - start)
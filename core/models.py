@@ -1,9 +1,13 @@
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import Case, Count, F, FloatField, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce
+from django.db.models.signals import post_delete, post_save
 from django.conf import settings
 from django.shortcuts import reverse
 from django_countries.fields import CountryField
 
+from .versions import bump_version
+
 CATEGORY_CHOICES = (
     ('S', 'Shirt'),
     ('SW', 'Sport Wear'),
@@ -25,6 +29,11 @@ class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     stripe_customer_id = models.CharField(max_length=50, blank=True, null=True)
     one_click_purchasing = models.BooleanField(default=False)
+    # Maintained by core.checkout, rebuilt by backfill_default_addresses
+    default_shipping_address = models.ForeignKey(
+        'Address', related_name='+', on_delete=models.SET_NULL, blank=True, null=True)
+    default_billing_address = models.ForeignKey(
+        'Address', related_name='+', on_delete=models.SET_NULL, blank=True, null=True)
 
     def __str__(self):
         return self.full_name()
@@ -32,15 +41,47 @@ class UserProfile(models.Model):
     def full_name(self):
         return f'{self.first_name} {self.last_name}'
 
+class ItemQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # Bulk updates skip Item.save and its signals, so they bump the row
+        # versions and the catalog version themselves
+        kwargs.setdefault('version', F('version') + 1)
+        rows = super().update(**kwargs)
+        transaction.on_commit(lambda: bump_version(CATALOG_VERSION))
+        return rows
+
+
 class Item(models.Model):
     title = models.CharField(max_length=100)
     price = models.FloatField()
     discount_price = models.FloatField(blank=True, null=True)
     category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
     description = models.TextField()
     image = models.ImageField()
+    # Bumped on every save, part of the cached product card keys
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    objects = ItemQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        # Incremented by the database, concurrent saves get distinct versions.
+        # Read back before the save itself, so post_save receivers see the
+        # new number
+        with transaction.atomic():
+            row = Item._base_manager.filter(pk=self.pk)
+            if not row.update(version=F('version') + 1):
+                return super().save(*args, **kwargs)
+            self.version = row.values_list('version', flat=True).get()
+            if kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name != 'version'
+                ]
+            super().save(*args, **kwargs)
 
     def get_absolute_url(self):
         return reverse('core:product', kwargs={'slug': self.slug})
@@ -51,6 +92,11 @@ class Item(models.Model):
     def get_remove_from_cart_url(self):
         return reverse('core:remove-from-cart', kwargs={'slug': self.slug})
 
+    def get_final_price(self):
+        if self.discount_price:
+            return self.discount_price
+        return self.price
+
     def __str__(self):
         return f'{self.title} - {self.price}€'
 
@@ -62,6 +108,11 @@ class OrderItem(models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'item', 'ordered'])
+        ]
+
     def __str__(self):
         return f'{self.quantity} of {self.item.title}'
 
@@ -80,9 +131,49 @@ class OrderItem(models.Model):
         return self.get_total_item_price()
 
 
+class OrderQuerySet(models.QuerySet):
+    def with_items(self):
+        # Everything the cart templates touch, loaded in three queries
+        # whatever the number of lines
+        return self.select_related('coupon').prefetch_related('items__item')
+
+    def with_totals(self):
+        # Annotate the money values of each order in a single aggregate query.
+        # Mirrors OrderItem.get_final_price: a truthy discount_price wins over price
+        price = F('items__item__price')
+        discount_price = F('items__item__discount_price')
+        is_discounted = (Q(items__item__discount_price__gt=0) |
+                         Q(items__item__discount_price__lt=0))
+        quantity = F('items__quantity')
+
+        final_price = Case(
+            When(is_discounted, then=quantity * discount_price),
+            default=quantity * price,
+            output_field=FloatField()
+        )
+        saved = Case(
+            When(is_discounted, then=quantity * (price - discount_price)),
+            default=Value(0.0),
+            output_field=FloatField()
+        )
+        coupon_rate = Coalesce(
+            Cast('coupon__discount', FloatField()), Value(0.0)) / Value(100.0)
+
+        return self.annotate(
+            items_subtotal=Coalesce(Sum(final_price), Value(0.0)),
+            items_savings=Coalesce(Sum(saved), Value(0.0)),
+            items_count=Count('items'),
+        ).annotate(
+            order_total=F('items_subtotal') * (Value(1.0) - coupon_rate)
+        )
+
+
+# Denormalised cart totals kept on Order, see Order.update_totals()
+ORDER_TOTAL_FIELDS = ['subtotal', 'discount_total', 'line_count', 'unit_count']
+
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    ref_code = models.CharField(max_length=20, blank=True, null=True)
+    ref_code = models.CharField(max_length=20, blank=True, null=True, unique=True)
     items = models.ManyToManyField(OrderItem)
     start_date = models.DateTimeField(auto_now_add=True)
     ordered_date = models.DateTimeField()
@@ -95,18 +186,120 @@ class Order(models.Model):
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
+    # Cart totals, maintained by the cart views and admin
+    subtotal = models.FloatField(default=0)
+    discount_total = models.FloatField(default=0)
+    line_count = models.IntegerField(default=0)
+    unit_count = models.IntegerField(default=0)
+    # The order's Stripe PaymentIntent and its amount in cents, see core.payments
+    stripe_intent_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_intent_amount = models.IntegerField(blank=True, null=True)
+    stripe_client_secret = models.CharField(max_length=255, blank=True, null=True)
+    # The intent succeeded but could not complete the order, see core.webhooks
+    payment_problem = models.BooleanField(default=False)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # A user has at most one open cart, see core.cart
+            models.UniqueConstraint(fields=['user'], condition=Q(ordered=False),
+                                    name='unique_open_order_per_user')
+        ]
+        indexes = [
+            models.Index(fields=['user', 'ordered']),
+            # Webhook events find their order by PaymentIntent
+            models.Index(fields=['stripe_intent_id'])
+        ]
 
     def __str__(self):
         return f'{self.user} on {self.ordered_date}'
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()        
-        if self.coupon:
-            total = total*(1-(self.coupon.discount/100))
-        
-        return total
+        return self.subtotal - self.discount_total
+
+    def get_coupon_rate(self):
+        if self.coupon and self.coupon.discount:
+            return self.coupon.discount / 100
+        return 0
+
+    def compute_totals(self):
+        # Recompute the cart totals from the order items (one query, or none
+        # when they were loaded with OrderQuerySet.with_items)
+        subtotal = 0
+        line_count = 0
+        unit_count = 0
+        if 'items' in getattr(self, '_prefetched_objects_cache', {}):
+            order_items = self.items.all()
+        else:
+            order_items = self.items.select_related('item')
+
+        for order_item in order_items:
+            subtotal += order_item.get_final_price()
+            line_count += 1
+            unit_count += order_item.quantity
+
+        return {
+            'subtotal': subtotal,
+            'discount_total': subtotal * self.get_coupon_rate(),
+            'line_count': line_count,
+            'unit_count': unit_count,
+        }
+
+    def update_totals(self, extra_fields=()):
+        # Rebuild the stored totals, e.g. after a coupon or admin change
+        for field, value in self.compute_totals().items():
+            setattr(self, field, value)
+        self.save(update_fields=ORDER_TOTAL_FIELDS + list(extra_fields))
+
+    def rebuild_totals(self):
+        # Recompute the stored totals from the order lines in a single UPDATE.
+        # Removals use it: taking off today's price of an item added at
+        # another price would drift away from compute_totals(). The instance
+        # reloads its totals when they are next read
+        lines = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        is_discounted = Q(item__discount_price__gt=0) | Q(item__discount_price__lt=0)
+        final_price = Case(
+            When(is_discounted, then=F('quantity') * F('item__discount_price')),
+            default=F('quantity') * F('item__price'),
+            output_field=FloatField()
+        )
+
+        def aggregate(expression, output_field, empty):
+            return Coalesce(Subquery(lines.annotate(value=expression).values('value'),
+                                     output_field=output_field), Value(empty))
+
+        subtotal = aggregate(Sum(final_price), FloatField(), 0.0)
+        Order.objects.filter(pk=self.pk).update(
+            subtotal=subtotal,
+            discount_total=subtotal * Value(float(self.get_coupon_rate())),
+            line_count=aggregate(Count('pk'), IntegerField(), 0),
+            unit_count=aggregate(Sum('quantity'), IntegerField(), 0)
+        )
+        for field in ORDER_TOTAL_FIELDS:
+            self.__dict__.pop(field, None)
+
+    def apply_item_delta(self, item, quantity, lines=0):
+        # Shift the stored totals by `quantity` units of `item` in a single
+        # UPDATE, so concurrent cart clicks cannot overwrite each other. The
+        # UPDATE reads the price from the item's row: the Item passed in may
+        # come from core.item_cache. The instance reloads its totals when
+        # they are next read
+        is_discounted = Q(discount_price__gt=0) | Q(discount_price__lt=0)
+        price = Item.objects.filter(pk=item.pk).values(final_price=Case(
+            When(is_discounted, then=F('discount_price')),
+            default=F('price'),
+            output_field=FloatField()
+        ))
+        amount = float(quantity) * Subquery(price)
+        Order.objects.filter(pk=self.pk).update(
+            subtotal=F('subtotal') + amount,
+            discount_total=(F('subtotal') + amount) * Value(float(self.get_coupon_rate())),
+            line_count=F('line_count') + lines,
+            unit_count=F('unit_count') + quantity
+        )
+        for field in ORDER_TOTAL_FIELDS:
+            self.__dict__.pop(field, None)
 
 class Address(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -124,6 +317,9 @@ class Address(models.Model):
     
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            models.Index(fields=['user', 'address_type', 'default'])
+        ]
 
 class Payment(models.Model):
     stripe_charge_id = models.CharField(max_length=50)
@@ -135,7 +331,7 @@ class Payment(models.Model):
         return f'{self.user.username} - {self.amount}'
 
 class Coupon(models.Model):
-    code = models.CharField(max_length=15)
+    code = models.CharField(max_length=15, unique=True)
     discount = models.IntegerField(blank=True, null=True)
 
     def __str__(self):
@@ -146,12 +342,115 @@ class Refund(models.Model):
     reason = models.TextField()
     accepted = models.BooleanField(default=False)
     email = models.EmailField()
+    # Issued by core.refunds as part of `run`, `error` is set when it gave up
+    run = models.ForeignKey('BulkRun', on_delete=models.SET_NULL, blank=True, null=True)
+    stripe_refund_id = models.CharField(max_length=255, blank=True, null=True)
+    refunded = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
 
     def __str__(self):
         return f'{self.pk}'
 
+# Job.status values, see core.jobs
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+JOB_STATUS_CHOICES = (
+    (JOB_QUEUED, 'queued'),
+    (JOB_RUNNING, 'running'),
+    (JOB_DONE, 'done'),
+    (JOB_FAILED, 'failed'),
+)
+
+class BulkRun(models.Model):
+    # Progress of a long running admin action, see core.bulk and core.refunds
+    action = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=JOB_STATUS_CHOICES, default=JOB_QUEUED)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    # Order actions: the orders per chunk and the last order changed
+    batch_size = models.PositiveIntegerField(default=0)
+    last_pk = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.action} #{self.pk}'
+
+    def progress(self):
+        return f'{self.done + self.failed} / {self.total}'
+
+class BulkRunOrder(models.Model):
+    # An order selected for a run of core.bulk and not changed yet
+    run = models.ForeignKey(BulkRun, on_delete=models.CASCADE, related_name='orders')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            # Also the index chunks are read from, in order
+            models.UniqueConstraint(fields=['run', 'order'], name='unique_bulkrunorder')
+        ]
+
+class Job(models.Model):
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    # Enqueueing again with the same key returns the existing job
+    idempotency_key = models.CharField(max_length=255, blank=True, null=True, unique=True)
+    status = models.CharField(max_length=10, choices=JOB_STATUS_CHOICES, default=JOB_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField()
+    run_at = models.DateTimeField()
+    # The worker running the job and until when, a crashed worker's jobs are
+    # picked up again once its lease runs out
+    locked_by = models.CharField(max_length=100, blank=True, null=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'])
+        ]
+
+    def __str__(self):
+        return f'{self.name} #{self.pk} ({self.status})'
+
+class WebhookEvent(models.Model):
+    # Payment provider events as delivered, appended by core.webhooks and
+    # never changed afterwards except for being marked processed, with the
+    # traceback of the error if processing failed
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.TextField()
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # The events still to be processed
+            models.Index(fields=['id'], condition=Q(processed=None), name='webhookevent_pending')
+        ]
+
+    def __str__(self):
+        return f'{self.type} {self.event_id}'
+
 def userprofile_receiver(sender, instance, created, *args, **kwargs):
     if created:
         userprofile = UserProfile.objects.create(user=instance)
 
-post_save.connect(userprofile_receiver, sender=settings.AUTH_USER_MODEL)
\ No newline at end of file
+# Invalidates everything built from the catalog, see core.versions
+CATALOG_VERSION = 'catalog'
+
+def item_changed_receiver(sender, *args, **kwargs):
+    # After the commit: bumped any earlier, a concurrent read could cache the
+    # old row under the new version
+    transaction.on_commit(lambda: bump_version(CATALOG_VERSION))
+
+post_save.connect(userprofile_receiver, sender=settings.AUTH_USER_MODEL)
+post_save.connect(item_changed_receiver, sender=Item)
+post_delete.connect(item_changed_receiver, sender=Item)
\ No newline at end of file
@@ -0,0 +1,80 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from .models import CATALOG_VERSION
+from .versions import get_version
+
+# Whole-page cache for anonymous catalog pages, enabled by the
+# ANONYMOUS_PAGE_CACHE setting. Pages are keyed by the catalog version, so
+# they live until an Item changes.
+PAGE_CACHE_TIMEOUT = 60 * 60
+
+
+def is_cacheable_request(request):
+    # Never for signed in users, and never while flash messages are
+    # waiting to be shown (len() does not mark them as read)
+    return (
+        request.method in ('GET', 'HEAD') and
+        not request.user.is_authenticated and
+        not len(get_messages(request))
+    )
+
+
+def is_cacheable_response(request, response):
+    # Responses that set cookies or rendered a CSRF token are per visitor
+    return (
+        response.status_code == 200 and
+        not response.cookies and
+        not request.META.get('CSRF_COOKIE_USED')
+    )
+
+
+def page_key(request):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'page:{get_version(CATALOG_VERSION)}:{path}'
+
+
+def finalize(request, response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # Anonymous and signed in visitors share URLs, keep shared caches apart
+    # and make browsers revalidate instead of trusting a stale copy
+    patch_vary_headers(response, ['Cookie'])
+    patch_cache_control(response, no_cache=True)
+    return get_conditional_response(
+        request, etag=etag, last_modified=last_modified, response=response)
+
+
+def anonymous_page_cache(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not settings.ANONYMOUS_PAGE_CACHE or not is_cacheable_request(request):
+            return view(request, *args, **kwargs)
+
+        key = page_key(request)
+        entry = cache.get(key)
+        if entry is not None:
+            content, content_type, etag, last_modified = entry
+            response = HttpResponse(content, content_type=content_type)
+            return finalize(request, response, etag, last_modified)
+
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response = response.render()
+        if not is_cacheable_response(request, response):
+            return response
+
+        etag = '"%s"' % hashlib.sha1(response.content).hexdigest()
+        last_modified = int(time.time())
+        cache.set(key, (response.content, response['Content-Type'], etag, last_modified),
+                  PAGE_CACHE_TIMEOUT)
+        return finalize(request, response, etag, last_modified)
+    return wrapper
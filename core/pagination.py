@@ -0,0 +1,120 @@
+import base64
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db.models import Q
+
+# Cached catalog counts only feed optional "n results" displays
+COUNT_CACHE_TIMEOUT = 60 * 5
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPage:
+    is_keyset = True
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    # Seeks on a unique ordering (e.g. ('id',) or ('price', 'id')) instead of
+    # using OFFSET, so every page costs one indexed range scan of per_page rows
+    def __init__(self, queryset, per_page, ordering=('id',)):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = tuple(ordering)
+
+    @property
+    def count(self):
+        key = 'keyset-count:' + hashlib.md5(str(self.queryset.query).encode()).hexdigest()
+        return cache.get_or_set(key, self.queryset.count, COUNT_CACHE_TIMEOUT)
+
+    def encode_cursor(self, obj, direction):
+        values = [getattr(obj, field.lstrip('-')) for field in self.ordering]
+        payload = json.dumps([direction, values], separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            direction, values = json.loads(base64.urlsafe_b64decode(padded))
+        except (TypeError, ValueError):
+            raise InvalidCursor(cursor)
+        if (direction not in (NEXT, PREVIOUS) or not isinstance(values, list) or
+                len(values) != len(self.ordering) or
+                not all(isinstance(value, (str, int, float)) and not isinstance(value, bool)
+                        for value in values)):
+            raise InvalidCursor(cursor)
+        return direction, values
+
+    def seek(self, values, direction):
+        # (a, b) > (x, y) expands to a > x OR (a = x AND b > y)
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            ascending = (field[0] != '-') == (direction == NEXT)
+            step = Q(**{f'{name}__{"gt" if ascending else "lt"}': values[i]})
+            for previous_field, value in zip(self.ordering[:i], values):
+                step &= Q(**{previous_field.lstrip('-'): value})
+            condition |= step
+        return condition
+
+    def page(self, cursor=None):
+        direction, values = self.decode_cursor(cursor) if cursor else (NEXT, None)
+
+        if direction == NEXT:
+            ordering = self.ordering
+        else:
+            ordering = [field[1:] if field[0] == '-' else f'-{field}' for field in self.ordering]
+
+        queryset = self.queryset.order_by(*ordering)
+        if values is not None:
+            try:
+                queryset = queryset.filter(self.seek(values, direction))
+            except (TypeError, ValueError):
+                # Well-formed, but e.g. a string for an integer field
+                raise InvalidCursor(values)
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == PREVIOUS:
+            rows.reverse()
+
+        if not rows:
+            return KeysetPage(rows)
+
+        # Walking forward there is always a previous page once a cursor was
+        # followed, walking backwards there is always a next page
+        has_next = has_more if direction == NEXT else True
+        has_previous = values is not None if direction == NEXT else has_more
+
+        return KeysetPage(
+            rows,
+            next_cursor=self.encode_cursor(rows[-1], NEXT) if has_next else None,
+            previous_cursor=self.encode_cursor(rows[0], PREVIOUS) if has_previous else None
+        )
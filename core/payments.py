@@ -0,0 +1,203 @@
+import asyncio
+import secrets
+import string
+import weakref
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from . import cart
+from .instrumentation import timer
+from .models import Order, OrderItem, Payment
+
+# For the views and the background jobs alike
+stripe.api_key = settings.STRIPE_SECRET_KEY
+stripe.api_base = settings.STRIPE_API_BASE
+
+# The order's PaymentIntent is kept on the Order and reused across payment
+# page loads. Stripe is only called when there is none yet or the amount
+# changed, with Idempotency-Keys derived from the order and amount so
+# retries and double clicks cannot create a second intent.
+CREATED = 'created'
+UPDATED = 'updated'
+REUSED = 'reused'
+CURRENCY = 'eur'
+
+# The async views talk to Stripe through one pooled httpx client per event
+# loop, its keep-alive connections cannot be shared between loops
+_async_clients = weakref.WeakKeyDictionary()
+
+# Order.ref_code is '<order id in base 36>-<random>', unique by construction
+# and unguessable. Codes from before have no '-' and cannot clash either
+REF_CODE_ALPHABET = string.digits + string.ascii_lowercase
+REF_CODE_LENGTH = Order._meta.get_field('ref_code').max_length
+
+
+class PaymentIncomplete(Exception):
+    pass
+
+
+class AlreadyOrdered(Exception):
+    pass
+
+
+def async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = stripe.StripeClient(
+            stripe.api_key,
+            base_addresses={'api': stripe.api_base},
+            max_network_retries=stripe.max_network_retries,
+            http_client=stripe.HTTPXClient(timeout=settings.STRIPE_TIMEOUT)
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def order_amount(order):
+    # What the order costs in cents: its stored totals, the amount the cart
+    # shows. Item prices changed with a queryset update() only reach open
+    # carts through the rebuild_order_totals command
+    return round(order.get_total() * 100)
+
+
+def idempotency_key(order, amount, replaces=None):
+    key = f'order-{order.pk}-amount-{amount}'
+    if replaces:
+        key = f'{key}-replaces-{replaces}'
+    return key
+
+
+def create_params(order, amount, replaces=None):
+    params = {'amount': amount, 'currency': CURRENCY, 'metadata': {'order_id': order.pk}}
+    return params, {'idempotency_key': idempotency_key(order, amount, replaces)}
+
+
+def stored_intent(order, amount):
+    if order.stripe_intent_id and order.stripe_intent_amount == amount:
+        return REUSED, order.stripe_intent_id, order.stripe_client_secret
+    return None
+
+
+def store_intent(order, intent, amount):
+    order.stripe_intent_id = intent.id
+    order.stripe_intent_amount = amount
+    order.stripe_client_secret = intent.client_secret
+    order.payment_problem = False
+    Order.objects.filter(pk=order.pk).update(
+        stripe_intent_id=intent.id,
+        stripe_intent_amount=amount,
+        stripe_client_secret=intent.client_secret,
+        payment_problem=False
+    )
+
+
+def create_intent(order, amount, replaces=None):
+    params, options = create_params(order, amount, replaces)
+    with timer('stripe'):
+        return stripe.PaymentIntent.create(**params, **options)
+
+
+def payment_intent(order, amount):
+    # Returns (result, intent id, client secret) for an intent of `amount`
+    # cents. Raises stripe.error.StripeError
+    stored = stored_intent(order, amount)
+    if stored:
+        return stored
+
+    if order.stripe_intent_id:
+        result = UPDATED
+        try:
+            # Setting an amount is idempotent by itself
+            with timer('stripe'):
+                intent = stripe.PaymentIntent.modify(order.stripe_intent_id, amount=amount)
+        except stripe.error.InvalidRequestError:
+            # Cancelled, or otherwise past the point of changing its amount
+            result = CREATED
+            intent = create_intent(order, amount, replaces=order.stripe_intent_id)
+    else:
+        result = CREATED
+        intent = create_intent(order, amount)
+
+    store_intent(order, intent, amount)
+    return result, intent.id, intent.client_secret
+
+
+async def create_intent_async(order, amount, replaces=None):
+    params, options = create_params(order, amount, replaces)
+    with timer('stripe'):
+        return await async_client().v1.payment_intents.create_async(params, options)
+
+
+async def payment_intent_async(order, amount):
+    # payment_intent() for the async views
+    stored = stored_intent(order, amount)
+    if stored:
+        return stored
+
+    if order.stripe_intent_id:
+        result = UPDATED
+        try:
+            with timer('stripe'):
+                intent = await async_client().v1.payment_intents.update_async(
+                    order.stripe_intent_id, {'amount': amount})
+        except stripe.error.InvalidRequestError:
+            result = CREATED
+            intent = await create_intent_async(order, amount, replaces=order.stripe_intent_id)
+    else:
+        result = CREATED
+        intent = await create_intent_async(order, amount)
+
+    await sync_to_async(store_intent)(order, intent, amount)
+    return result, intent.id, intent.client_secret
+
+
+def check_paid(order, intent):
+    # The intent must have paid the order's current total in full, raises
+    # PaymentIncomplete. Not the amount stored with the intent: the cart may
+    # have changed since the payment page was loaded
+    if (intent.status != 'succeeded' or intent.currency != CURRENCY or
+            intent.amount != order_amount(order)):
+        raise PaymentIncomplete(intent.id)
+
+
+def base36(number):
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = REF_CODE_ALPHABET[digit] + digits
+        if not number:
+            return digits
+
+
+def create_ref_code(order_pk):
+    prefix = f'{base36(order_pk)}-'
+    return prefix + ''.join(secrets.choice(REF_CODE_ALPHABET)
+                            for _ in range(REF_CODE_LENGTH - len(prefix)))
+
+
+def finalize_order(order, user_id, amount):
+    # Marks an order as paid with its PaymentIntent, which charged `amount`
+    # cents: one INSERT for the Payment, one UPDATE for the order and one for
+    # its lines, whatever the cart size. Raises AlreadyOrdered if a
+    # concurrent confirmation got there first
+    ref_code = create_ref_code(order.pk)
+    with transaction.atomic():
+        payment = Payment.objects.create(
+            stripe_charge_id=order.stripe_intent_id,
+            user_id=user_id,
+            amount=amount / 100
+        )
+        if not Order.objects.filter(pk=order.pk, ordered=False).update(
+                ordered=True, payment=payment, ref_code=ref_code):
+            raise AlreadyOrdered(order.pk)
+        OrderItem.objects.filter(order=order).update(ordered=True)
+        cart.forget_item_count(user_id)
+
+    order.ordered = True
+    order.payment = payment
+    order.ref_code = ref_code
+    return payment
@@ -0,0 +1,95 @@
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+from django.conf import settings
+
+# Opt-in cProfile capture of single requests, written as pstats files to
+# PROFILING_DIR/<view label>/ and listed on the staff page /admin/profiles/
+PROFILES_KEPT_PER_VIEW = 50
+PROFILE_HEADER = 'HTTP_X_PROFILE_TOKEN'
+
+logger = logging.getLogger(__name__)
+
+# Only one request is profiled at a time per process
+_lock = threading.Lock()
+
+
+def view_label(view_func, method):
+    # CheckoutView.post for class based views, add_to_cart for functions
+    view_class = getattr(view_func, 'view_class', None)
+    if view_class is not None:
+        return f'{view_class.__name__}.{method.lower()}'
+    return view_func.__name__
+
+
+def is_requested(request):
+    token = settings.PROFILING_TOKEN
+    if token and request.META.get(PROFILE_HEADER) == token:
+        return True
+    return request.GET.get('profile') == '1' and request.user.is_staff
+
+
+def should_profile(request):
+    url_names = settings.PROFILING_URL_NAMES
+    match = request.resolver_match
+    if url_names and (match is None or match.view_name not in url_names):
+        return False
+    return is_requested(request) or random.random() < settings.PROFILING_SAMPLE_RATE
+
+
+def profile_call(label, func, *args, **kwargs):
+    if not _lock.acquire(blocking=False):
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+    finally:
+        _lock.release()
+        # A full disk must not replace the view's response or exception
+        try:
+            save_profile(label, profiler)
+        except Exception:
+            logger.exception('Could not save the profile of %s', label)
+    return result
+
+
+def save_profile(label, profiler):
+    directory = os.path.join(settings.PROFILING_DIR, label)
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, f'{time.time():.6f}.prof'))
+
+    for name in sorted(os.listdir(directory))[:-PROFILES_KEPT_PER_VIEW]:
+        os.remove(os.path.join(directory, name))
+
+
+def list_profiles(limit=10):
+    # {label: [(timestamp, path), ...]} with the newest profiles first
+    profiles = {}
+    if not os.path.isdir(settings.PROFILING_DIR):
+        return profiles
+    for label in sorted(os.listdir(settings.PROFILING_DIR)):
+        directory = os.path.join(settings.PROFILING_DIR, label)
+        names = sorted(os.listdir(directory), reverse=True)[:limit]
+        profiles[label] = [(float(name[:-len('.prof')]), os.path.join(directory, name))
+                           for name in names if name.endswith('.prof')]
+    return profiles
+
+
+def top_functions(path, limit=15):
+    stats = pstats.Stats(path)
+    rows = []
+    for (filename, line, function), (cc, calls, total, cumulative, callers) in stats.stats.items():
+        rows.append({
+            'function': f'{function} ({os.path.basename(filename)}:{line})',
+            'calls': calls,
+            'total': total * 1000,
+            'cumulative': cumulative * 1000,
+        })
+    rows.sort(key=lambda row: row['cumulative'], reverse=True)
+    return stats.total_tt * 1000, rows[:limit]
@@ -0,0 +1,141 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import jobs
+from .models import BulkRun, Order, Refund, JOB_DONE, JOB_QUEUED, JOB_RUNNING
+
+# Refunds through Stripe. accept() puts refunds in a BulkRun and a job
+# issues them in chunks of REFUND_BATCH_SIZE: the calls go out from a pool
+# of REFUND_THREADS threads at no more than REFUND_RATE_LIMIT per second,
+# rate limit and connection errors are retried with backoff and a chunk's
+# results are written back with one bulk_update. Each chunk is a job of its
+# own, so a run survives worker restarts, and Idempotency-Keys make a
+# repeated call for a refund within a run return the refund issued before.
+ISSUE_REFUNDS = 'issue_refunds'
+RUN_ACTION = 'refunds'
+RETRYABLE_ERRORS = (stripe.error.RateLimitError, stripe.error.APIConnectionError, stripe.error.APIError)
+
+# Rate: RateLimiter, shared by the runs of a worker process
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    # Spaces calls from any number of threads 1 / rate seconds apart
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_call = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            call = max(self.next_call, now)
+            self.next_call = call + self.interval
+        time.sleep(call - now)
+
+
+def rate_limiter():
+    with _limiters_lock:
+        rate = settings.REFUND_RATE_LIMIT
+        if rate not in _limiters:
+            _limiters[rate] = RateLimiter(rate)
+        return _limiters[rate]
+
+
+def accept(refunds):
+    # Accepts the `refunds` not refunded yet, failed ones included, and
+    # queues a run issuing them. Returns the BulkRun, None if there were none
+    with transaction.atomic():
+        run = BulkRun.objects.create(action=RUN_ACTION)
+        run.total = refunds.filter(refunded=None).update(accepted=True, run=run, error='')
+        if not run.total:
+            transaction.set_rollback(True)
+            return None
+        BulkRun.objects.filter(pk=run.pk).update(total=run.total)
+        resume(run)
+    return run
+
+
+def resume(run):
+    # Continues an unfinished run from a job, unless one is queued or running
+    # already. Returns whether it queued one
+    if jobs.active(ISSUE_REFUNDS, run_id=run.pk):
+        return False
+    jobs.enqueue(ISSUE_REFUNDS, {'run_id': run.pk})
+    return True
+
+
+def retry_delay(attempt):
+    delay = settings.REFUND_RETRY_DELAY * 2 ** (attempt - 1)
+    return random.uniform(delay / 2, delay)
+
+
+def issue(refund):
+    # Returns (Stripe refund id, None) or (None, error message)
+    payment = refund.order.payment
+    if payment is None:
+        return None, 'The order has no payment'
+    # Payments from before PaymentIntents hold a charge id
+    if payment.stripe_charge_id.startswith('ch_'):
+        params = {'charge': payment.stripe_charge_id}
+    else:
+        params = {'payment_intent': payment.stripe_charge_id}
+    # Per run, a new run may retry what failed in the last one
+    key = f'refund-{refund.pk}-run-{refund.run_id}'
+
+    for attempt in range(1, settings.REFUND_MAX_ATTEMPTS + 1):
+        rate_limiter().wait()
+        try:
+            return stripe.Refund.create(**params, idempotency_key=key).id, None
+        except RETRYABLE_ERRORS as e:
+            if attempt == settings.REFUND_MAX_ATTEMPTS:
+                return None, str(e) or type(e).__name__
+            time.sleep(retry_delay(attempt))
+        except stripe.error.StripeError as e:
+            return None, e.user_message or str(e) or type(e).__name__
+
+
+def issue_chunk(refunds):
+    # Issues `refunds` from the thread pool and sets their outcome, returns
+    # how many succeeded
+    with ThreadPoolExecutor(settings.REFUND_THREADS, thread_name_prefix='refund') as pool:
+        results = list(pool.map(issue, refunds))
+
+    now = timezone.now()
+    for refund, (refund_id, error) in zip(refunds, results):
+        refund.stripe_refund_id = refund_id
+        refund.refunded = now if refund_id else None
+        refund.error = error or ''
+    return sum(1 for refund_id, error in results if refund_id)
+
+
+@jobs.task(ISSUE_REFUNDS)
+def issue_refunds(run_id):
+    # Issues the next chunk of the run and queues the one after
+    BulkRun.objects.filter(pk=run_id, status=JOB_QUEUED).update(status=JOB_RUNNING)
+    refunds = list(Refund.objects.select_related('order__payment').filter(
+        run=run_id, refunded=None, error=''
+    ).order_by('pk')[:settings.REFUND_BATCH_SIZE])
+    if not refunds:
+        BulkRun.objects.filter(pk=run_id).update(status=JOB_DONE, finished=timezone.now())
+        return
+
+    done = issue_chunk(refunds)
+    with transaction.atomic():
+        Refund.objects.bulk_update(refunds, ['stripe_refund_id', 'refunded', 'error'])
+        Order.objects.filter(pk__in=[refund.order_id for refund in refunds if refund.refunded]).update(
+            refund_granted=True)
+        BulkRun.objects.filter(pk=run_id).update(
+            done=F('done') + done,
+            failed=F('failed') + len(refunds) - done
+        )
+        jobs.enqueue(ISSUE_REFUNDS, {'run_id': run_id}, key=f'refunds-{run_id}-after-{refunds[-1].pk}')
@@ -0,0 +1,147 @@
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+
+from .models import Item
+
+# Full-text index over Item.title and Item.description, kept in a side table:
+# an FTS5 virtual table on SQLite and a tsvector column with a GIN index on
+# Postgres. Other backends fall back to an icontains scan.
+SQLITE_TABLE = 'core_item_fts'
+POSTGRES_TABLE = 'core_item_search'
+SEARCH_CONFIG = 'english'
+
+POSTGRES_DOCUMENT = (
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', %s), 'A') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', %s), 'B')"
+)
+
+
+def has_index():
+    return connection.vendor in ('sqlite', 'postgresql')
+
+
+def index_table():
+    return SQLITE_TABLE if connection.vendor == 'sqlite' else POSTGRES_TABLE
+
+
+def create_index(**kwargs):
+    # Connected to post_migrate, so `manage.py migrate` (and the test runner)
+    # create the side table next to core_item
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_TABLE} '
+                f'USING fts5(title, description)')
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {POSTGRES_TABLE} ('
+                f'item_id integer PRIMARY KEY REFERENCES core_item (id) '
+                f'ON DELETE CASCADE, '
+                f'document tsvector NOT NULL)')
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {POSTGRES_TABLE}_document_idx '
+                f'ON {POSTGRES_TABLE} USING gin (document)')
+
+
+def index_item(item):
+    if not has_index():
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {SQLITE_TABLE} WHERE rowid = %s', [item.pk])
+            cursor.execute(
+                f'INSERT INTO {SQLITE_TABLE} (rowid, title, description) VALUES (%s, %s, %s)',
+                [item.pk, item.title, item.description])
+        else:
+            cursor.execute(
+                f'INSERT INTO {POSTGRES_TABLE} (item_id, document) '
+                f'VALUES (%s, {POSTGRES_DOCUMENT}) '
+                f'ON CONFLICT (item_id) DO UPDATE SET document = EXCLUDED.document',
+                [item.pk, item.title, item.description])
+
+
+def unindex_item(item_id):
+    if not has_index():
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {SQLITE_TABLE} WHERE rowid = %s', [item_id])
+        else:
+            cursor.execute(f'DELETE FROM {POSTGRES_TABLE} WHERE item_id = %s', [item_id])
+
+
+def rebuild_index():
+    if not has_index():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {index_table()}')
+    count = 0
+    for item in Item.objects.only('title', 'description').iterator():
+        index_item(item)
+        count += 1
+    return count
+
+
+def fts5_query(query):
+    # Quote every term so user input cannot inject FTS5 operators, the last
+    # term also matches as a prefix
+    terms = [term.replace('"', '""') for term in re.findall(r'\w+', query)]
+    return ' '.join(f'"{term}"' for term in terms[:-1]) + (f' "{terms[-1]}"*' if terms else '')
+
+
+def match_sql(query):
+    # (SQL selecting the ids of the matches, SQL ranking the item of the outer
+    # query, their parameters), or None when `query` has no terms. Lower
+    # ranks are better matches
+    item = f'"{Item._meta.db_table}"."id"'
+    if connection.vendor == 'sqlite':
+        match = fts5_query(query)
+        if not match:
+            return None
+        return (
+            f'SELECT rowid FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s',
+            f'SELECT rank FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s AND rowid = {item}',
+            [match]
+        )
+    tsquery = f"plainto_tsquery('{SEARCH_CONFIG}', %s)"
+    return (
+        f'SELECT item_id FROM {POSTGRES_TABLE} WHERE document @@ {tsquery}',
+        f'SELECT -ts_rank(document, {tsquery}) FROM {POSTGRES_TABLE} WHERE item_id = {item}',
+        [query]
+    )
+
+
+def search_items(queryset, query):
+    # Filters `queryset` to the matches of `query` and annotates their rank
+    # as `search_rank` (lower is better), so callers can order or
+    # keyset-paginate on ('search_rank', 'id'). Both stay in the SQL of the
+    # page query, nothing is ranked in Python. The rank is a correlated
+    # subquery though: the ORDER BY and the keyset seek evaluate it for every
+    # match on every page, so a page costs in proportion to the matches
+    if not has_index():
+        return queryset.filter(
+            Q(title__icontains=query) | Q(description__icontains=query)
+        ).annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+    sql = match_sql(query)
+    if sql is None:
+        return queryset.none().annotate(search_rank=Value(0.0, output_field=FloatField()))
+    matches, rank, params = sql
+    return queryset.filter(pk__in=RawSQL(matches, params)).annotate(
+        search_rank=RawSQL(rank, params, output_field=FloatField()))
+
+
+def item_saved_receiver(sender, instance, *args, **kwargs):
+    index_item(instance)
+
+
+def item_deleted_receiver(sender, instance, *args, **kwargs):
+    unindex_item(instance.pk)
+
+
+post_save.connect(item_saved_receiver, sender=Item)
+post_delete.connect(item_deleted_receiver, sender=Item)
@@ -1,5 +1,5 @@
 from django import template
-from core.models import Order
+from core import cart
 
 register = template.Library()
 
@@ -7,7 +7,5 @@ register = template.Library()
 @register.filter
 def cart_item_count(user):
     if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
+        return cart.get_item_count(user)
     return 0
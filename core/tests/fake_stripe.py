@@ -0,0 +1,229 @@
+import collections
+import copy
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+# A local stand-in for the parts of the Stripe API the shop uses, so tests
+# and benchmarks run offline. Point stripe.api_base (or STRIPE_API_BASE) at
+# FakeStripe.url. Idempotency-Key replays return the first response, like
+# Stripe, `latency` delays every response and with `rate_limit` requests
+# beyond that many per second are refused with a 429.
+MODIFIABLE_STATUSES = {'requires_payment_method', 'requires_confirmation', 'requires_action'}
+
+# Webhook events recorded from Stripe's test mode, see recorded_event()
+EVENTS_DIR = os.path.join(os.path.dirname(__file__), 'stripe_events')
+
+
+class StripeHTTPError(Exception):
+    def __init__(self, status, message, code=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {'error': {'type': 'invalid_request_error', 'message': message, 'code': code}}
+
+
+def parse_params(body):
+    # metadata[order_id]=1 style keys into nested dicts
+    params = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        if '[' in key and key.endswith(']'):
+            name, subkey = key[:-1].split('[', 1)
+            params.setdefault(name, {})[subkey] = value
+        else:
+            params[key] = value
+    return params
+
+
+def recorded_event(name, event_id=None, **fields):
+    # The recorded `name` event, with `fields` of its data.object replaced
+    with open(os.path.join(EVENTS_DIR, f'{name}.json')) as f:
+        event = json.load(f)
+    if event_id:
+        event['id'] = event_id
+    event['data']['object'].update(fields)
+    return event
+
+
+def sign_payload(payload, secret, timestamp=None):
+    # The Stripe-Signature header Stripe sends with a webhook `payload`
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    fake = None
+    # Headers and body go out in separate writes, don't let the body wait
+    # for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond('GET', {})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.respond('POST', parse_params(self.rfile.read(length).decode()))
+
+    def respond(self, method, params):
+        status, body = self.fake.handle(method, self.path.split('?')[0], params,
+                                        self.headers.get('Idempotency-Key'))
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Request-Id', f'req_{uuid.uuid4().hex[:14]}')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeStripe:
+    def __init__(self, latency=0, rate_limit=0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.intents = {}
+        self.refunds = {}
+        # Arrival times of the requests of the last second
+        self.recent = collections.deque()
+        # (method, path, params, Idempotency-Key) of every request received
+        self.requests = []
+        self.responses = {}
+        self.lock = threading.Lock()
+        handler = type('Handler', (FakeStripeHandler,), {'fake': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, method, path, params, key):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests.append((method, path, params, key))
+            if self.rate_limited():
+                return 429, {'error': {
+                    'type': 'invalid_request_error',
+                    'code': 'rate_limit',
+                    'message': 'Request rate limit exceeded.'
+                }}
+            if key is not None and key in self.responses:
+                request, response = self.responses[key]
+                if request != (method, path, params):
+                    return 400, {'error': {
+                        'type': 'idempotency_error',
+                        'message': f'Keys for idempotent requests can only be used with the same parameters, {key}'
+                    }}
+                return response
+
+            try:
+                response = 200, copy.deepcopy(self.route(method, path, params))
+            except StripeHTTPError as e:
+                response = e.status, e.body
+            if key is not None:
+                self.responses[key] = ((method, path, params), response)
+            return response
+
+    def route(self, method, path, params):
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['v1', 'payment_intents']:
+            if len(parts) == 2 and method == 'POST':
+                return self.create_intent(params)
+            if len(parts) == 3:
+                intent = self.get_intent(parts[2])
+                if method == 'GET':
+                    return intent
+                return self.modify_intent(intent, params)
+        if parts == ['v1', 'refunds'] and method == 'POST':
+            return self.create_refund(params)
+        raise StripeHTTPError(404, f'Unrecognized request URL ({method}: {path})')
+
+    def rate_limited(self):
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        while self.recent and self.recent[0] < now - 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.rate_limit:
+            return True
+        self.recent.append(now)
+        return False
+
+    def get_intent(self, intent_id):
+        if intent_id not in self.intents:
+            raise StripeHTTPError(404, f"No such payment_intent: '{intent_id}'", 'resource_missing')
+        return self.intents[intent_id]
+
+    def create_intent(self, params):
+        intent_id = f'pi_{uuid.uuid4().hex[:24]}'
+        intent = {
+            'id': intent_id,
+            'object': 'payment_intent',
+            'amount': int(params['amount']),
+            'currency': params.get('currency', 'eur'),
+            'client_secret': f'{intent_id}_secret_{uuid.uuid4().hex[:24]}',
+            'metadata': params.get('metadata', {}),
+            'status': 'requires_payment_method',
+        }
+        self.intents[intent_id] = intent
+        return intent
+
+    def modify_intent(self, intent, params):
+        if intent['status'] not in MODIFIABLE_STATUSES:
+            raise StripeHTTPError(
+                400,
+                f"This PaymentIntent's amount could not be updated because it has a status of {intent['status']}.",
+                'payment_intent_unexpected_state'
+            )
+        if 'amount' in params:
+            intent['amount'] = int(params['amount'])
+        intent['metadata'].update(params.get('metadata', {}))
+        return intent
+
+    def create_refund(self, params):
+        intent = self.get_intent(params.get('payment_intent', ''))
+        if intent['status'] != 'succeeded':
+            raise StripeHTTPError(400, f"PaymentIntent {intent['id']} has not succeeded.", 'charge_not_succeeded')
+        if intent.get('amount_refunded'):
+            raise StripeHTTPError(400, f"Charge for {intent['id']} has already been refunded.",
+                                  'charge_already_refunded')
+        intent['amount_refunded'] = int(params.get('amount', intent['amount']))
+        refund_id = f're_{uuid.uuid4().hex[:24]}'
+        refund = {
+            'id': refund_id,
+            'object': 'refund',
+            'amount': intent['amount_refunded'],
+            'currency': intent['currency'],
+            'payment_intent': intent['id'],
+            'status': 'succeeded',
+        }
+        self.refunds[refund_id] = refund
+        return refund
+
+    def intent_requests(self, method=None):
+        return [request for request in self.requests
+                if request[1].startswith('/v1/payment_intents') and method in (None, request[0])]
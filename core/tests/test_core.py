@@ -0,0 +1,1299 @@
+import base64
+import copy
+import json
+import re
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import stripe
+from asgiref.sync import async_to_sync, sync_to_async
+from django import forms
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.models.signals import post_save
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .. import autocomplete, bulk, cart, checkout, instrumentation, item_cache, jobs, metrics, payments, profiling, refunds, search, versions, webhooks
+from .fake_stripe import FakeStripe, recorded_event, sign_payload
+from ..forms import CheckoutForm
+from ..instrumentation import RequestMetrics
+from ..models import Item, Order, OrderItem, Address, BulkRun, BulkRunOrder, Coupon, Job, Payment, Refund, UserProfile, WebhookEvent, CATALOG_VERSION, JOB_DONE, JOB_FAILED, JOB_QUEUED
+from ..pagination import KeysetPaginator
+from ..template_tags.cart_template_tags import cart_item_count
+from ..views import AsyncPaymentView, OrderConfirmedView
+
+
+def create_item(slug, price=10.0, discount_price=None):
+    return Item.objects.create(
+        title=slug.title(),
+        price=price,
+        discount_price=discount_price,
+        category='S',
+        label='P',
+        slug=slug,
+        description=f'Description of {slug}',
+        image='sample.jpg'
+    )
+
+
+class CartTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            'shopper', 'shopper@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def add(self, slug):
+        return self.client.get(reverse('core:add-to-cart', kwargs={'slug': slug}))
+
+    def get_order(self):
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def fill_cart(self, lines):
+        # Top the cart up to `lines` distinct items
+        order = Order.objects.filter(user=self.user, ordered=False).first()
+        for i in range(order.line_count if order else 0, lines):
+            cart.add_item(self.user, create_item(f'line-{i}', price=10.0 + i, discount_price=9.0))
+
+    def assertQueryBudget(self, budget, url, sizes=(1, 30)):
+        # The page must cost exactly `budget` queries for every cart size,
+        # measured on a second request so the cart badge cache is warm
+        for size in sizes:
+            self.fill_cart(size)
+            self.client.get(url)
+            with self.subTest(lines=size), self.assertNumQueries(budget):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class OrderTotalsTests(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        create_item('shirt', price=20.0, discount_price=15.0)
+        create_item('jacket', price=80.0)
+
+    def assertTotalsMatch(self, order):
+        expected = order.compute_totals()
+        for field, value in expected.items():
+            self.assertAlmostEqual(getattr(order, field), value, places=2)
+
+    def test_cart_views_maintain_totals(self):
+        self.add('shirt')
+        self.add('shirt')
+        self.add('jacket')
+        order = self.get_order()
+        self.assertAlmostEqual(order.get_total(), 110.0)
+        self.assertEqual((order.line_count, order.unit_count), (2, 3))
+
+        self.client.get(reverse('core:remove-single-item-from-cart', kwargs={'slug': 'shirt'}))
+        self.client.get(reverse('core:remove-from-cart', kwargs={'slug': 'jacket'}))
+        order = self.get_order()
+        self.assertAlmostEqual(order.get_total(), 15.0)
+        self.assertEqual((order.line_count, order.unit_count), (1, 1))
+        self.assertTotalsMatch(order)
+
+    def test_removals_follow_price_changes(self):
+        self.add('jacket')
+        self.add('jacket')
+        self.add('shirt')
+        Item.objects.filter(slug='jacket').update(price=100.0)
+        self.client.get(reverse('core:remove-single-item-from-cart', kwargs={'slug': 'jacket'}))
+        order = self.get_order()
+        self.assertAlmostEqual(order.get_total(), 115.0)
+        self.assertTotalsMatch(order)
+        self.client.get(reverse('core:remove-from-cart', kwargs={'slug': 'jacket'}))
+        order = self.get_order()
+        self.assertEqual((order.line_count, order.unit_count), (1, 1))
+        self.assertTotalsMatch(order)
+
+    def test_coupon_updates_discount_total(self):
+        Coupon.objects.create(code='TENOFF', discount=10)
+        self.add('jacket')
+        self.client.post(reverse('core:add-coupon'), {'code': 'TENOFF'})
+        self.add('jacket')
+        order = self.get_order()
+        self.assertAlmostEqual(order.get_total(), 144.0)
+        self.assertTotalsMatch(order)
+
+    def test_get_total_costs_no_queries(self):
+        for _ in range(3):
+            self.add('jacket')
+        order = self.get_order()
+        with self.assertNumQueries(0):
+            order.get_total()
+
+    def test_admin_saves_leave_placed_orders_alone(self):
+        self.add('jacket')
+        order = self.get_order()
+        Order.objects.filter(pk=order.pk).update(ordered=True)
+        Item.objects.filter(slug='jacket').update(price=99.0)
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.post(reverse('admin:core_order_change', args=[order.pk]), {
+            'user': self.user.pk, 'ordered_date_0': '2024-01-01', 'ordered_date_1': '10:00:00',
+            'items': list(order.items.values_list('pk', flat=True)), 'ordered': 'on', 'being_delivered': 'on'
+        })
+        order = Order.objects.get(pk=order.pk)
+        self.assertTrue(order.being_delivered)
+        self.assertAlmostEqual(order.get_total(), 80.0)
+
+    def test_the_charge_is_the_cart_total(self):
+        self.add('jacket')
+        Item.objects.filter(slug='jacket').update(price=99.0)
+        self.assertEqual(payments.order_amount(self.get_order()), 8000)
+
+    def test_rebuild_command_fixes_stale_totals(self):
+        self.add('jacket')
+        Order.objects.update(subtotal=0)
+        call_command('rebuild_order_totals', stdout=StringIO())
+        self.assertAlmostEqual(self.get_order().get_total(), 80.0)
+
+
+class OrderWithTotalsTests(CartTestCase):
+    def test_matches_python_totals(self):
+        create_item('shirt', price=19.99, discount_price=14.49)
+        create_item('jacket', price=79.95)
+        create_item('socks', price=3.33, discount_price=0)
+        for slug in ['shirt', 'shirt', 'jacket', 'socks', 'socks', 'socks']:
+            self.add(slug)
+        order = self.get_order()
+        order.coupon = Coupon.objects.create(code='SEVEN', discount=7)
+        order.update_totals(extra_fields=['coupon'])
+
+        annotated = Order.objects.with_totals().get(pk=order.pk)
+        savings = sum(order_item.get_amount_saved() for order_item in order.items.all()
+                      if order_item.item.discount_price)
+        self.assertEqual(round(annotated.order_total, 2), round(order.get_total(), 2))
+        self.assertEqual(round(annotated.items_subtotal, 2), round(order.subtotal, 2))
+        self.assertEqual(round(annotated.items_savings, 2), round(savings, 2))
+        self.assertEqual(annotated.items_count, 3)
+
+    def test_empty_order_totals_are_zero(self):
+        order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+        annotated = Order.objects.with_totals().get(pk=order.pk)
+        self.assertEqual((annotated.order_total, annotated.items_count), (0, 0))
+
+
+class CartServiceTests(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        self.item = create_item('shirt')
+
+    def test_mutations_stay_within_query_budget(self):
+        cart.add_item(self.user, self.item)
+        # SAVEPOINT/RELEASE from the atomic block plus three statements, the
+        # item's current price is read by the UPDATE of the totals
+        with self.assertNumQueries(5):
+            self.assertEqual(cart.add_item(self.user, self.item), cart.UPDATED)
+        with self.assertNumQueries(5):
+            self.assertEqual(cart.remove_single_item(self.user, self.item), cart.UPDATED)
+        self.assertEqual(self.get_order().unit_count, 1)
+
+    def test_remove_single_item_drops_last_unit(self):
+        cart.add_item(self.user, self.item)
+        cart.remove_single_item(self.user, self.item)
+        order = self.get_order()
+        self.assertEqual(order.items.count(), 0)
+        self.assertEqual((order.line_count, order.unit_count), (0, 0))
+        self.assertFalse(OrderItem.objects.filter(user=self.user, ordered=False).exists())
+        self.assertEqual(cart.remove_item(self.user, self.item), cart.NOT_IN_CART)
+
+
+class ConcurrentCartTests(TransactionTestCase):
+    threads = 8
+
+    def test_parallel_adds_share_one_order(self):
+        user = get_user_model().objects.create_user('racer', 'racer@example.com', 'password')
+        item = create_item('shirt')
+        barrier = threading.Barrier(self.threads)
+        errors = []
+
+        def click():
+            try:
+                barrier.wait()
+                cart.add_item(user, item)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=click) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        order = Order.objects.get(user=user, ordered=False)
+        self.assertEqual(order.items.get().quantity, self.threads)
+        self.assertEqual(order.unit_count, self.threads)
+
+
+class CartItemCountTests(CartTestCase):
+    def test_badge_is_served_from_cache(self):
+        self.assertEqual(cart_item_count(self.user), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            cart.add_item(self.user, create_item('shirt'))
+            cart.add_item(self.user, create_item('jacket'))
+        # Each commit retired the entry, the first view reads it again
+        with self.assertNumQueries(1):
+            self.assertEqual(cart_item_count(self.user), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart_item_count(self.user), 2)
+
+    def test_counts_read_before_a_change_are_never_served_after_it(self):
+        # A view read the count, then a cart change committed before the view
+        # stored what it read
+        key = cart.item_count_key(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            cart.add_item(self.user, create_item('shirt'))
+        cache.set(key, 0)
+        self.assertEqual(cart_item_count(self.user), 1)
+
+    def test_cold_miss_reads_open_order(self):
+        cart.add_item(self.user, create_item('shirt'))
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(cart_item_count(self.user), 1)
+
+
+class LookupIndexTests(CartTestCase):
+    # Fails when one of the hot lookups falls back to a full table scan
+    def assertUsesIndex(self, queryset):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # Tiny test tables would otherwise always be seq scanned
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            full_scan = re.compile(r'Seq Scan')
+        elif connection.vendor == 'sqlite':
+            full_scan = re.compile(r'\bSCAN\b')
+        else:
+            self.skipTest(f'No plan check for {connection.vendor}')
+
+        plan = queryset.explain()
+        self.assertIsNone(full_scan.search(plan), plan)
+
+    def test_hot_lookups_use_indexes(self):
+        item = create_item('shirt')
+        lookups = [
+            Item.objects.filter(slug='shirt'),
+            Order.objects.filter(user=self.user, ordered=False),
+            OrderItem.objects.filter(user=self.user, item=item, ordered=False),
+            Address.objects.filter(user=self.user, address_type='S', default=True),
+            Order.objects.filter(ref_code='abc'),
+            Coupon.objects.filter(code='TENOFF'),
+        ]
+        for queryset in lookups:
+            with self.subTest(model=queryset.model.__name__):
+                self.assertUsesIndex(queryset)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        for i in range(25):
+            create_item(f'item-{i}', price=float(i % 4))
+
+    def walk(self, paginator):
+        pages, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            pages.append([item.slug for item in page])
+            if not page.has_next():
+                return pages, page
+            cursor = page.next_cursor
+
+    def test_walks_forward_and_back_on_compound_key(self):
+        queryset = Item.objects.all()
+        paginator = KeysetPaginator(queryset, 10, ('price', 'id'))
+        pages, last = self.walk(paginator)
+        expected = [item.slug for item in queryset.order_by('price', 'id')]
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), expected)
+
+        previous = paginator.page(last.previous_cursor)
+        self.assertEqual([item.slug for item in previous], pages[1])
+        first = paginator.page(previous.previous_cursor)
+        self.assertEqual([item.slug for item in first], pages[0])
+        self.assertFalse(first.has_previous())
+
+    def test_deep_pages_cost_one_query(self):
+        paginator = KeysetPaginator(Item.objects.all(), 10)
+        cursor = paginator.page().next_cursor
+        with self.assertNumQueries(1):
+            paginator.page(cursor)
+
+    def test_home_view_pages_by_cursor(self):
+        response = self.client.get(reverse('core:home'))
+        self.assertEqual(len(response.context['object_list']), 10)
+        cursor = response.context['page_obj'].next_cursor
+        self.assertContains(response, f'?cursor={cursor}')
+        self.assertEqual(self.client.get(reverse('core:home'), {'cursor': 'garbage'}).status_code, 404)
+
+    def test_malformed_cursors_are_not_found(self):
+        for payload in [['n', 5], ['n', ['x']], ['n', ['x', 'y']], ['n', [None]], 'n']:
+            with self.subTest(payload=payload):
+                cursor = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+                response = self.client.get(reverse('core:home'), {'cursor': cursor})
+                self.assertEqual(response.status_code, 404)
+
+
+class CatalogSearchTests(TestCase):
+    def setUp(self):
+        create_item('blue-shirt', price=20.0)
+        jacket = create_item('rain-jacket', price=90.0)
+        jacket.category = 'O'
+        jacket.description = 'A waterproof shell for blue autumn days'
+        jacket.save()
+        create_item('running-tights', price=30.0)
+
+    def slugs(self, **params):
+        response = self.client.get(reverse('core:home'), params)
+        return [item.slug for item in response.context['object_list']]
+
+    def test_filters_by_category(self):
+        self.assertEqual(self.slugs(category='O'), ['rain-jacket'])
+        self.assertEqual(len(self.slugs(category='bogus')), 3)
+
+    def test_ranks_title_matches_first(self):
+        self.assertEqual(self.slugs(q='blue'), ['blue-shirt', 'rain-jacket'])
+        self.assertEqual(self.slugs(q='blue', category='O'), ['rain-jacket'])
+        self.assertEqual(self.slugs(q='waterpr'), ['rain-jacket'])
+
+    def test_index_follows_item_changes(self):
+        Item.objects.get(slug='running-tights').delete()
+        self.assertEqual(self.slugs(q='tights'), [])
+        shirt = Item.objects.get(slug='blue-shirt')
+        shirt.title = 'Green Shirt'
+        shirt.save()
+        self.assertEqual(self.slugs(q='green'), ['blue-shirt'])
+
+    def test_operators_in_query_are_literal(self):
+        self.assertEqual(self.slugs(q='blue" OR "tights'), [])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        for i in range(15):
+            create_item(f'wool-jacket-{i}')
+        create_item('linen-shirt')
+
+    def test_pages_through_every_match(self):
+        slugs, params = [], {'q': 'jack'}
+        while True:
+            page = self.client.get(reverse('core:home'), params).context['page_obj']
+            slugs += [item.slug for item in page]
+            if not page.has_next():
+                break
+            params['cursor'] = page.next_cursor
+        self.assertEqual(sorted(slugs), sorted(f'wool-jacket-{i}' for i in range(15)))
+
+    def test_ranks_in_the_page_query(self):
+        queryset = search.search_items(Item.objects.all(), 'linen shirt').order_by('search_rank', 'id')
+        with self.assertNumQueries(1):
+            self.assertEqual([item.slug for item in queryset], ['linen-shirt'])
+        self.assertFalse(search.search_items(Item.objects.all(), '!!').exists())
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Each test builds its own index
+        patcher = mock.patch.object(autocomplete, '_index', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_item('blue-shirt', price=20.0, discount_price=15.0)
+        create_item('blue-jeans', price=60.0)
+        create_item('red-shirt', price=20.0)
+
+    def suggest(self, prefix):
+        response = self.client.get(reverse('core:autocomplete'), {'q': prefix})
+        return [result['slug'] for result in response.json()['results']]
+
+    def test_matches_any_word_prefix(self):
+        self.assertEqual(self.suggest('blu'), ['blue-jeans', 'blue-shirt'])
+        self.assertEqual(self.suggest('shi'), ['blue-shirt', 'red-shirt'])
+        self.assertEqual(self.suggest('Blue Sh'), ['blue-shirt'])
+        self.assertEqual(self.suggest(''), [])
+
+    def test_answers_from_memory_until_catalog_changes(self):
+        self.suggest('blu')
+        with self.assertNumQueries(0):
+            self.assertEqual(autocomplete.suggest('red')[0]['price'], 20.0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_item('red-scarf')
+        # The old index answers while the new one is built, here inline as
+        # the test database is not visible to other threads
+        with mock.patch.object(autocomplete, 'start_refresh', autocomplete.refresh):
+            self.assertEqual(self.suggest('red'), ['red-shirt'])
+        self.assertEqual(self.suggest('red'), ['red-scarf', 'red-shirt'])
+
+
+class ItemCacheTests(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        item_cache.local_cache.clear()
+        self.item = create_item('shirt', price=20.0)
+
+    def test_lookups_skip_the_database_once_warm(self):
+        self.client.logout()
+        item_cache.get_item(slug='shirt')
+        with self.assertNumQueries(0):
+            self.assertEqual(item_cache.get_item(slug='shirt').pk, self.item.pk)
+            self.client.get(self.item.get_absolute_url())
+        item_cache.local_cache.clear()
+        shared_hits = metrics.REGISTRY.get_sample_value(
+            'ecommerce_item_cache_lookups_total', {'result': 'shared'}) or 0
+        with self.assertNumQueries(0):
+            item_cache.get_item(slug='shirt')
+        self.assertEqual(metrics.REGISTRY.get_sample_value(
+            'ecommerce_item_cache_lookups_total', {'result': 'shared'}), shared_hits + 1)
+
+    def test_item_save_invalidates(self):
+        item_cache.get_item(pk=self.item.pk)
+        self.item.price = 25.0
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.item.save()
+            # Until the commit readers may still see the old row, it must
+            # not be cached under a new version
+            self.assertEqual(item_cache.get_item(pk=self.item.pk).price, 20.0)
+        callbacks[0]()
+        self.assertEqual(item_cache.get_item(pk=self.item.pk).price, 25.0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.delete()
+        self.assertIsNone(item_cache.get_item(slug='shirt'))
+        self.assertEqual(self.client.get(reverse('core:product', kwargs={'slug': 'shirt'})).status_code, 404)
+
+    def test_cart_prices_come_from_the_database(self):
+        cached = item_cache.get_item(slug='shirt')
+        Item.objects.filter(pk=self.item.pk).update(price=30.0)
+        cart.add_item(self.user, cached)
+        self.assertEqual(self.get_order().subtotal, 30.0)
+
+
+class ProductCardCacheTests(TestCase):
+    def test_card_follows_item_version(self):
+        cache.clear()
+        item = create_item('shirt')
+        self.assertContains(self.client.get(reverse('core:home')), 'Shirt')
+        item.title = 'Renamed Shirt'
+        item.save()
+        self.assertEqual(item.version, 2)
+        self.assertContains(self.client.get(reverse('core:home')), 'Renamed Shirt')
+
+    def test_concurrent_saves_get_distinct_versions(self):
+        item = create_item('shirt')
+        stale = Item.objects.get(pk=item.pk)
+        item.save()
+        stale.save(update_fields=['title'])
+        self.assertEqual((item.version, stale.version), (2, 3))
+
+    def test_receivers_see_the_new_version(self):
+        item = create_item('shirt')
+        seen = []
+        receiver = lambda sender, instance, **kwargs: seen.append(instance.version)
+        post_save.connect(receiver, sender=Item)
+        self.addCleanup(post_save.disconnect, receiver, sender=Item)
+        item.save()
+        self.assertEqual(seen, [2])
+
+    def test_queryset_updates_bump_the_versions(self):
+        item = create_item('shirt')
+        catalog = versions.get_version(CATALOG_VERSION)
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.filter(pk=item.pk).update(title='Renamed Shirt')
+        item.refresh_from_db()
+        self.assertEqual(item.version, 2)
+        self.assertGreater(versions.get_version(CATALOG_VERSION), catalog)
+
+
+@override_settings(ANONYMOUS_PAGE_CACHE=True)
+class AnonymousPageCacheTests(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.logout()
+        self.item = create_item('shirt')
+
+    def test_repeat_visits_revalidate_with_etag(self):
+        url = self.item.get_absolute_url()
+        first = self.client.get(url)
+        self.assertTrue(first.has_header('ETag'))
+        self.assertIn('Cookie', first['Vary'])
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(url)
+        self.assertEqual(cached.content, first.content)
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_item_change_yields_new_page(self):
+        url = reverse('core:home')
+        etag = self.client.get(url)['ETag']
+        self.item.title = 'Renamed Shirt'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Renamed Shirt')
+
+    def test_signed_in_users_bypass_the_cache(self):
+        self.client.get(reverse('core:home'))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('core:home'))
+        self.assertFalse(response.has_header('ETag'))
+        self.assertContains(response, 'Logout')
+
+
+class CheckoutAddressTests(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        create_item('shirt')
+        self.add('shirt')
+        self.form = {'payment_option': 'S'}
+        for prefix in ['shipping', 'billing']:
+            self.form.update({
+                f'{prefix}_first_name': 'Ada',
+                f'{prefix}_last_name': 'Lovelace',
+                f'{prefix}_address': f'1 {prefix.title()} Street',
+                f'{prefix}_country': 'GB',
+                f'{prefix}_zip': 'N1',
+            })
+
+    def post(self, **flags):
+        data = dict(self.form, **{flag: 'on' for flag, value in flags.items() if value})
+        return self.client.post(reverse('core:checkout'), data)
+
+    def test_new_addresses(self):
+        response = self.post(set_default_shipping=True)
+        self.assertRedirects(response, reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                             fetch_redirect_response=False)
+        order = self.get_order()
+        self.assertEqual(order.shipping_address.street_address, '1 Shipping Street')
+        self.assertEqual(order.billing_address.street_address, '1 Billing Street')
+        self.assertEqual(checkout.default_addresses(self.user.pk), {'S': order.shipping_address})
+
+    def test_same_billing_address_copies_shipping(self):
+        self.post(same_billing_address=True, set_default_billing=True)
+        order = self.get_order()
+        self.assertNotEqual(order.billing_address.pk, order.shipping_address.pk)
+        self.assertEqual(order.billing_address.address_type, 'B')
+        self.assertEqual(order.billing_address.street_address, '1 Shipping Street')
+        self.assertFalse(order.shipping_address.default)
+        self.assertTrue(order.billing_address.default)
+
+    def test_new_default_replaces_the_old_one(self):
+        self.post(set_default_shipping=True, set_default_billing=True)
+        first = self.get_order()
+        self.form['shipping_address'] = '2 Shipping Street'
+        self.post(set_default_shipping=True)
+        defaults = checkout.default_addresses(self.user.pk)
+        self.assertEqual(defaults['S'].street_address, '2 Shipping Street')
+        self.assertEqual(defaults['B'], first.billing_address)
+        self.assertEqual(Address.objects.filter(user=self.user, default=True).count(), 2)
+
+    def test_use_defaults(self):
+        self.post(set_default_shipping=True, set_default_billing=True)
+        defaults = checkout.default_addresses(self.user.pk)
+        addresses = Address.objects.count()
+        self.post(use_default_shipping=True, use_default_billing=True)
+        order = self.get_order()
+        self.assertEqual(order.shipping_address, defaults['S'])
+        self.assertEqual(order.billing_address, defaults['B'])
+        self.assertEqual(Address.objects.count(), addresses)
+
+    def test_default_addresses_are_cached(self):
+        self.post(set_default_shipping=True, set_default_billing=True)
+        cache.clear()
+        with self.assertNumQueries(1):
+            defaults = checkout.default_addresses(self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(checkout.default_addresses(self.user.pk), defaults)
+        self.assertEqual(set(defaults), {'S', 'B'})
+
+        defaults['S'].delete()
+        self.assertEqual(set(checkout.default_addresses(self.user.pk)), {'B'})
+
+    def test_unset_defaults_leave_the_profile(self):
+        self.post(set_default_shipping=True, set_default_billing=True)
+        defaults = checkout.default_addresses(self.user.pk)
+        defaults['B'].street_address = '3 Billing Street'
+        defaults['B'].save()
+        self.assertEqual(checkout.default_addresses(self.user.pk)['B'].street_address, '3 Billing Street')
+
+        defaults['S'].default = False
+        defaults['S'].save()
+        self.assertEqual(set(checkout.default_addresses(self.user.pk)), {'B'})
+        self.assertIsNone(UserProfile.objects.get(user=self.user).default_shipping_address)
+
+    def test_backfill_from_default_flags(self):
+        self.post(set_default_shipping=True, set_default_billing=True)
+        defaults = checkout.default_addresses(self.user.pk)
+        UserProfile.objects.update(
+            default_shipping_address=None, default_billing_address=None)
+        out = StringIO()
+        call_command('backfill_default_addresses', stdout=out)
+        self.assertIn('1 profiles updated', out.getvalue())
+        self.assertEqual(checkout.default_addresses(self.user.pk), defaults)
+
+    def test_invalid_submissions_write_nothing(self):
+        self.form['billing_zip'] = ''
+        for flags, message in [
+            ({'use_default_shipping': True}, 'No default shipping address available'),
+            ({'use_default_billing': True}, 'No default billing address available'),
+            ({}, 'Please fill in the required billing address fields'),
+        ]:
+            with self.subTest(**flags):
+                response = self.post(**flags)
+                self.assertRedirects(response, reverse('core:checkout'), fetch_redirect_response=False)
+                self.assertIn(message, [str(m) for m in response.wsgi_request._messages])
+                self.assertFalse(Address.objects.exists())
+                self.assertIsNone(self.get_order().shipping_address)
+
+
+class CountrySelectTests(TestCase):
+    def test_matches_django_countries_rendering(self):
+        from django_countries.fields import CountryField
+        from django_countries.widgets import CountrySelectWidget
+
+        class StockForm(forms.Form):
+            shipping_country = CountryField(blank_label='Select country').formfield(
+                required=False,
+                widget=CountrySelectWidget(attrs={'class': 'custom-select d-block w-100'}))
+
+        for data in [None, {'shipping_country': 'DE'}, {'shipping_country': 'FR'}]:
+            with self.subTest(data=data):
+                html = str(CheckoutForm(data)['shipping_country'])
+                self.assertHTMLEqual(html, str(StockForm(data)['shipping_country']))
+                self.assertEqual(html.count(' selected'), 1)
+
+    def test_validates_country_codes(self):
+        form = CheckoutForm({'shipping_country': 'XX', 'billing_country': 'NL', 'payment_option': 'S'})
+        self.assertEqual(list(form.errors), ['shipping_country'])
+
+
+class StripeTestCase(CartTestCase):
+    # Runs Stripe calls against core.tests.fake_stripe
+    def setUp(self):
+        super().setUp()
+        self.stripe = FakeStripe().start()
+        self.addCleanup(self.stripe.stop)
+        for name, value in [('api_base', self.stripe.url), ('api_key', 'sk_test_fake'),
+                            ('max_network_retries', 0)]:
+            patcher = mock.patch.object(stripe, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def set_billing_address(self):
+        order = self.get_order()
+        order.billing_address = Address.objects.create(
+            user=self.user, first_name='Ada', last_name='Lovelace', street_address='1 Street',
+            apartment_address='', country='GB', zip='N1', address_type='B')
+        order.save()
+        return order
+
+
+class PaymentIntentTests(StripeTestCase):
+    def setUp(self):
+        super().setUp()
+        create_item('shirt', price=20.0)
+        create_item('jacket', price=80.0)
+        self.add('shirt')
+        self.order = self.set_billing_address()
+        self.url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+
+    def test_reloads_reuse_the_intent(self):
+        first = self.client.get(self.url)
+        second = self.client.get(self.url)
+        self.assertEqual(first.context['intent_id'], second.context['intent_id'])
+        self.assertEqual(first.context['client_secret'], second.context['client_secret'])
+
+        [(method, path, params, key)] = self.stripe.requests
+        self.assertEqual((method, path, params['amount']), ('POST', '/v1/payment_intents', '2000'))
+        self.assertEqual(key, f'order-{self.order.pk}-amount-2000')
+        order = self.get_order()
+        self.assertEqual((order.stripe_intent_id, order.stripe_intent_amount),
+                         (first.context['intent_id'], 2000))
+
+    def test_amount_change_updates_the_intent(self):
+        intent_id = self.client.get(self.url).context['intent_id']
+        self.add('jacket')
+        self.assertEqual(self.client.get(self.url).context['intent_id'], intent_id)
+        self.assertEqual(self.stripe.intents[intent_id]['amount'], 10000)
+        self.assertEqual(len(self.stripe.intent_requests('POST')), 2)
+        self.assertEqual(self.get_order().stripe_intent_amount, 10000)
+
+    def test_cancelled_intent_is_replaced(self):
+        intent_id = self.client.get(self.url).context['intent_id']
+        self.stripe.intents[intent_id]['status'] = 'canceled'
+        self.add('jacket')
+        replacement = self.client.get(self.url).context['intent_id']
+        self.assertNotEqual(replacement, intent_id)
+        self.assertEqual(self.stripe.requests[-1][3],
+                         f'order-{self.order.pk}-amount-10000-replaces-{intent_id}')
+
+    def test_idempotency_key_deduplicates_creates(self):
+        order = self.get_order()
+        first = payments.create_intent(order, 2000)
+        self.assertEqual(payments.create_intent(order, 2000).id, first.id)
+        self.assertEqual(len(self.stripe.intents), 1)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class OrderConfirmationTests(StripeTestCase):
+    def setUp(self):
+        super().setUp()
+        create_item('shirt', price=20.0)
+        self.add('shirt')
+        self.set_billing_address()
+        self.payment_url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+        self.intent_id = self.client.get(self.payment_url).context['intent_id']
+
+    def deliver(self, name, secret='whsec_test', **fields):
+        payload = json.dumps(recorded_event(name, **fields))
+        return self.client.post(reverse('core:stripe-webhook'), payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=sign_payload(payload, secret))
+
+    def confirmation_page(self, intent_id=None):
+        return self.client.get(reverse('core:order-confirmed'), {'intent_id': intent_id or self.intent_id})
+
+    def test_webhook_completes_the_order(self):
+        self.assertTrue(self.confirmation_page().context['pending'])
+        response = self.deliver('payment_intent.succeeded', id=self.intent_id, amount=2000)
+        self.assertEqual(response.status_code, 200)
+        # Nothing but the inbox is written while Stripe waits
+        self.assertFalse(self.get_order().ordered)
+
+        self.assertEqual(jobs.run_pending(), 1)
+        order = Order.objects.get(user=self.user)
+        self.assertTrue(order.ordered)
+        self.assertEqual((order.payment.stripe_charge_id, order.payment.amount), (self.intent_id, 20.0))
+        self.assertIsNotNone(WebhookEvent.objects.get().processed)
+        # session, user, order + coupon, order items, items
+        with self.assertNumQueries(5):
+            response = self.confirmation_page()
+        self.assertFalse(response.context['pending'])
+        self.assertContains(response, 'Order Confirmed')
+
+    def test_redeliveries_are_dropped(self):
+        for _ in range(2):
+            self.assertEqual(self.deliver('payment_intent.succeeded', id=self.intent_id).status_code, 200)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.assertEqual(Job.objects.filter(name=webhooks.PROCESS_EVENTS).count(), 1)
+
+    def test_events_arriving_together_are_processed_in_one_batch(self):
+        self.deliver('payment_intent.succeeded', id=self.intent_id, amount=2000)
+        for number in range(2):
+            self.deliver('payment_intent.succeeded', event_id=f'evt_unknown_{number}', id=f'pi_unknown_{number}')
+        with mock.patch.object(webhooks, 'process_batch', wraps=webhooks.process_batch) as process_batch, \
+                self.assertLogs('core.webhooks', 'ERROR'):
+            jobs.run_pending()
+        self.assertEqual(Job.objects.filter(name=webhooks.PROCESS_EVENTS, status=JOB_DONE).count(), 3)
+        self.assertEqual(process_batch.call_count, 1)
+        self.assertFalse(WebhookEvent.objects.filter(processed=None).exists())
+        self.assertTrue(Order.objects.get(user=self.user).ordered)
+
+    def test_bad_signatures_are_refused(self):
+        response = self.deliver('payment_intent.succeeded', secret='whsec_other', id=self.intent_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_other_events_are_only_recorded(self):
+        self.deliver('payment_intent.payment_failed', id=self.intent_id)
+        self.assertEqual(Job.objects.count(), 0)
+        webhooks.process_events()
+        self.assertIsNotNone(WebhookEvent.objects.get().processed)
+        self.assertFalse(self.get_order().ordered)
+
+    @override_settings(ADMINS=[('Shop', 'admin@example.com')])
+    def test_mismatched_payments_mail_admins(self):
+        with self.assertLogs('core.webhooks', 'ERROR'):
+            self.deliver('payment_intent.succeeded', id=self.intent_id, amount=1500)
+            self.deliver('payment_intent.succeeded', event_id='evt_unknown', id='pi_unknown')
+            jobs.run_pending()
+        self.assertFalse(self.get_order().ordered)
+        self.assertEqual({message.subject for message in mail.outbox}, {
+            '[Django] Payment pi_unknown needs attention',
+            f'[Django] Payment {self.intent_id} needs attention'
+        })
+
+    def test_cart_changes_after_loading_the_payment_page_are_not_free(self):
+        # Paid in a tab opened before another item went into the cart
+        create_item('jacket', price=30.0)
+        self.add('jacket')
+        with self.assertLogs('core.webhooks', 'ERROR'):
+            self.deliver('payment_intent.succeeded', id=self.intent_id, amount=2000)
+            jobs.run_pending()
+        self.assertFalse(self.get_order().ordered)
+        self.assertFalse(Payment.objects.exists())
+        response = self.confirmation_page()
+        self.assertTrue(response.context['stuck'])
+        self.assertNotContains(response, 'http-equiv="refresh"')
+        self.assertContains(response, 'contact us')
+
+    def test_failing_events_do_not_hold_up_the_queue(self):
+        other = get_user_model().objects.create_user('other')
+        create_item('hat', price=5.0)
+        cart.add_item(other, Item.objects.get(slug='hat'))
+        Order.objects.filter(user=other).update(stripe_intent_id='pi_other')
+        self.deliver('payment_intent.succeeded', event_id='evt_mine', id=self.intent_id, amount=2000)
+        self.deliver('payment_intent.succeeded', event_id='evt_other', id='pi_other', amount=500)
+
+        finalize_order = payments.finalize_order
+        def failing(order, user_id, amount):
+            if order.stripe_intent_id == self.intent_id:
+                raise ValueError('broken')
+            finalize_order(order, user_id, amount)
+        with mock.patch.object(payments, 'finalize_order', failing), \
+                self.assertLogs('core.webhooks', 'ERROR'):
+            jobs.run_pending()
+
+        self.assertFalse(WebhookEvent.objects.filter(processed=None).exists())
+        self.assertIn('broken', WebhookEvent.objects.get(event_id='evt_mine').error)
+        self.assertEqual(WebhookEvent.objects.get(event_id='evt_other').error, '')
+        self.assertTrue(Order.objects.get(user=other).ordered)
+        self.assertFalse(self.get_order().ordered)
+        self.assertFalse(Payment.objects.filter(stripe_charge_id=self.intent_id).exists())
+        self.assertTrue(self.confirmation_page().context['stuck'])
+
+    def test_confirmation_page_stops_refreshing(self):
+        response = self.client.get(reverse('core:order-confirmed'), {'intent_id': self.intent_id, 'refresh': 3})
+        self.assertContains(response, 'refresh=4')
+        response = self.client.get(reverse('core:order-confirmed'), {
+            'intent_id': self.intent_id, 'refresh': OrderConfirmedView.max_refreshes})
+        self.assertFalse(response.context['pending'])
+        self.assertContains(response, 'contact us')
+
+    def test_foreign_intents_are_refused(self):
+        response = self.confirmation_page('pi_someone_else')
+        self.assertRedirects(response, self.payment_url, fetch_redirect_response=False)
+
+
+@override_settings(REFUND_RATE_LIMIT=1000, REFUND_THREADS=4, REFUND_RETRY_DELAY=0.05)
+class RefundPipelineTests(StripeTestCase):
+    def paid_order(self, number, status='succeeded'):
+        intent_id = f'pi_refund_{number}'
+        self.stripe.intents[intent_id] = {'id': intent_id, 'object': 'payment_intent', 'amount': 2000,
+                                          'currency': 'eur', 'metadata': {}, 'status': status}
+        user = get_user_model().objects.create_user(f'refunded-{number}')
+        payment = Payment.objects.create(stripe_charge_id=intent_id, user=user, amount=20.0)
+        order = Order.objects.create(user=user, ordered=True, ordered_date=timezone.now(),
+                                     payment=payment, ref_code=f'refund-{number}', refund_requested=True)
+        return Refund.objects.create(order=order, reason='Wrong size', email='shopper@example.com')
+
+    def test_refunds_are_issued_in_chunks(self):
+        for number in range(10):
+            self.paid_order(number)
+        with self.settings(REFUND_BATCH_SIZE=4):
+            run = refunds.accept(Refund.objects.all())
+            self.assertEqual(run.total, 10)
+            self.assertEqual(jobs.run_pending(), 4)
+
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.done, run.failed), (JOB_DONE, 10, 0))
+        self.assertEqual(set(Refund.objects.values_list('stripe_refund_id', flat=True)), set(self.stripe.refunds))
+        self.assertFalse(Refund.objects.filter(refunded=None).exists())
+        self.assertIsNone(refunds.accept(Refund.objects.all()))
+
+    def test_rate_limited_calls_are_retried(self):
+        self.stripe.rate_limit = 4
+        for number in range(8):
+            self.paid_order(number)
+        with self.settings(REFUND_MAX_ATTEMPTS=8):
+            refunds.accept(Refund.objects.all())
+            jobs.run_pending()
+        self.assertEqual(len(self.stripe.refunds), 8)
+        self.assertGreater(len(self.stripe.requests), 8)
+        self.assertEqual(BulkRun.objects.get().done, 8)
+
+    def test_failures_are_kept_for_another_run(self):
+        refund = self.paid_order(1, status='requires_payment_method')
+        refunds.accept(Refund.objects.all())
+        jobs.run_pending()
+        refund.refresh_from_db()
+        self.assertIn('has not succeeded', refund.error)
+        self.assertEqual(BulkRun.objects.get().failed, 1)
+        self.assertFalse(Order.objects.get(pk=refund.order_id).refund_granted)
+
+        self.stripe.intents['pi_refund_1']['status'] = 'succeeded'
+        refunds.accept(Refund.objects.all())
+        jobs.run_pending()
+        refund.refresh_from_db()
+        self.assertEqual((refund.error, refund.stripe_refund_id), ('', *self.stripe.refunds))
+
+    def test_repeated_calls_return_the_same_refund(self):
+        refund = Refund.objects.select_related('order__payment').get(pk=self.paid_order(1).pk)
+        self.assertEqual(refunds.issue(refund), refunds.issue(refund))
+        self.assertEqual(len(self.stripe.refunds), 1)
+
+    def test_admin_action_starts_a_run(self):
+        refund = self.paid_order(1)
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        response = self.client.post(reverse('admin:core_order_changelist'), {
+            'action': 'make_refund_accepted',
+            '_selected_action': [refund.order_id]
+        }, follow=True)
+        run = BulkRun.objects.get(action=refunds.RUN_ACTION)
+        self.assertContains(response, reverse('admin:core_bulkrun_change', args=[run.pk]))
+        order = Order.objects.get(pk=refund.order_id)
+        # Granted once the refund went through
+        self.assertEqual((order.refund_requested, order.refund_granted), (False, False))
+        jobs.run_pending()
+        self.assertTrue(Order.objects.get(pk=refund.order_id).refund_granted)
+        self.assertContains(self.client.get(reverse('admin:core_bulkrun_changelist')), '1 / 1')
+
+
+@override_settings(BULK_ACTION_BATCH_SIZE=2, BULK_ACTION_INLINE_LIMIT=4)
+class BulkActionTests(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        Order.objects.bulk_create(
+            Order(user=self.user, ordered=True, ordered_date=timezone.now(), ref_code=f'bulk-{i}')
+            for i in range(5))
+        self.orders = list(Order.objects.order_by('pk'))
+
+    def delivered(self):
+        return Order.objects.filter(being_delivered=True).count()
+
+    def test_small_selections_run_inline(self):
+        run = bulk.start('make_delivered', Order.objects.with_totals().filter(ref_code__lt='bulk-4'))
+        self.assertEqual((run.status, run.total, run.done), (JOB_DONE, 4, 4))
+        self.assertEqual(self.delivered(), 4)
+        self.assertFalse(Job.objects.exists())
+
+    def test_large_selections_run_in_a_job(self):
+        run = bulk.start('make_delivered', Order.objects.with_totals())
+        self.assertEqual((run.status, self.delivered()), (JOB_QUEUED, 0))
+        jobs.run_pending()
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.total, run.done), (JOB_DONE, 5, 5))
+        self.assertEqual(self.delivered(), 5)
+
+    def test_runs_change_the_orders_selected_when_they_started(self):
+        run = bulk.start('make_delivered', Order.objects.with_totals())
+        later = Order.objects.create(user=self.user, ordered=True, ordered_date=timezone.now(), ref_code='later')
+        jobs.run_pending()
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.total, run.done), (JOB_DONE, 5, 5))
+        self.assertFalse(Order.objects.get(pk=later.pk).being_delivered)
+        self.assertFalse(BulkRunOrder.objects.exists())
+
+    def test_chunks_follow_the_selection(self):
+        # Orders far apart are one chunk, not one per range of primary keys
+        sparse = Order.objects.filter(pk__in=[self.orders[0].pk, self.orders[-1].pk])
+        with mock.patch.object(bulk, 'apply_chunk', wraps=bulk.apply_chunk) as apply_chunk:
+            run = bulk.start('make_delivered', sparse)
+        self.assertEqual((run.status, run.done, apply_chunk.call_count), (JOB_DONE, 2, 2))
+        self.assertEqual(self.delivered(), 2)
+
+    def test_interrupted_runs_resume_after_the_last_chunk(self):
+        run = bulk.start('make_received', Order.objects.all())
+        # The worker died after one chunk
+        Job.objects.all().delete()
+        self.assertTrue(bulk.apply_chunk(run))
+        self.assertEqual(run.last_pk, self.orders[1].pk)
+        # A stale copy of the run does not change the chunk again
+        stale = BulkRun.objects.get(pk=run.pk)
+        stale.last_pk = 0
+        self.assertFalse(bulk.apply_chunk(stale))
+
+        with self.settings(BULK_ACTION_JOB_SECONDS=0):
+            bulk.resume(run)
+            self.assertEqual(jobs.run_pending(), 3)
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.total, run.done), (JOB_DONE, 5, 5))
+        self.assertEqual(run.last_pk, self.orders[-1].pk)
+        self.assertEqual(Order.objects.filter(received=True).count(), 5)
+
+    def test_admin_actions_and_resume(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        response = self.client.post(reverse('admin:core_order_changelist'), {
+            'action': 'make_delivered',
+            '_selected_action': [self.orders[0].pk]
+        }, follow=True)
+        self.assertContains(response, '1 orders updated')
+
+        response = self.client.post(reverse('admin:core_order_changelist'), {
+            'action': 'make_received',
+            'select_across': 1,
+            '_selected_action': [self.orders[0].pk]
+        }, follow=True)
+        run = BulkRun.objects.get(action='make_received')
+        self.assertContains(response, reverse('admin:core_bulkrun_change', args=[run.pk]))
+
+        def resume():
+            return self.client.post(reverse('admin:core_bulkrun_changelist'), {
+                'action': 'resume_runs',
+                '_selected_action': [run.pk]
+            }, follow=True)
+        # Its job is still queued
+        self.assertContains(resume(), '0 runs resumed, 1 still have a job queued or running')
+        self.assertEqual(Job.objects.count(), 1)
+
+        Job.objects.update(status=JOB_FAILED)
+        self.assertContains(resume(), '1 runs resumed')
+        jobs.run_pending()
+        self.assertEqual(Order.objects.filter(received=True, being_delivered=False).count(), 5)
+        self.assertContains(self.client.get(reverse('admin:core_bulkrun_changelist')), '5 / 5')
+
+
+class FinalizeOrderTests(CartTestCase):
+    def paid_order(self):
+        Order.objects.filter(user=self.user, ordered=False).update(stripe_intent_id='pi_paid')
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def test_constant_queries_for_any_cart_size(self):
+        for lines in [1, 5]:
+            with self.subTest(lines=lines):
+                for i in range(lines):
+                    cart.add_item(self.user, create_item(f'cart-{lines}-{i}'))
+                order = self.paid_order()
+                # INSERT payment, UPDATE order, UPDATE lines and the savepoint
+                with self.assertNumQueries(5):
+                    payment = payments.finalize_order(order, self.user.pk, payments.order_amount(order))
+                self.assertEqual(payment.amount, order.get_total())
+                self.assertFalse(OrderItem.objects.filter(user=self.user, ordered=False).exists())
+                self.assertEqual(Order.objects.get(pk=order.pk).payment, payment)
+
+    def test_ref_codes_are_unique_by_order(self):
+        self.assertRegex(payments.create_ref_code(1), r'^1-[0-9a-z]{18}$')
+        self.assertRegex(payments.create_ref_code(36 ** 3), r'^1000-[0-9a-z]{15}$')
+
+    def test_second_confirmation_is_refused(self):
+        self.fill_cart(1)
+        order = self.paid_order()
+        payments.finalize_order(copy.copy(order), self.user.pk, 1000)
+        with self.assertRaises(payments.AlreadyOrdered):
+            payments.finalize_order(order, self.user.pk, 1000)
+        self.assertEqual(Payment.objects.count(), 1)
+
+
+class AsyncPaymentViewTests(StripeTestCase):
+    def setUp(self):
+        super().setUp()
+        create_item('shirt', price=20.0)
+        self.add('shirt')
+        self.set_billing_address()
+
+    def call(self, view, request, **kwargs):
+        request.user = self.user
+        request.session = self.client.session
+        request._messages = FallbackStorage(request)
+        return async_to_sync(view.as_view())(request, **kwargs)
+
+    def test_payment_page(self):
+        factory = RequestFactory()
+        for _ in range(2):
+            response = self.call(AsyncPaymentView, factory.get('/payment/stripe'), payment_option='stripe')
+            self.assertEqual(response.status_code, 200)
+        [intent_id] = self.stripe.intents
+        self.assertContains(response, intent_id)
+        self.assertEqual(len(self.stripe.requests), 1)
+
+    @mock.patch.object(autocomplete, '_index', None)
+    @override_settings(REQUEST_TIMING_SAMPLE_RATE=1)
+    async def test_middleware_runs_async_under_asgi(self):
+        self.user.is_staff = True
+        await sync_to_async(self.user.save)()
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await self.async_client.get(reverse('core:autocomplete'), {'q': 'sh'})
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'], r'^total;dur=[\d.]+$')
+
+
+class OrderPageQueryBudgetTests(CartTestCase):
+    # session, user, order + coupon, order items, items
+    def test_order_summary(self):
+        self.assertQueryBudget(5, reverse('core:order-summary'))
+
+    def test_checkout(self):
+        # the default addresses come from the per-user cache
+        self.assertQueryBudget(5, reverse('core:checkout'))
+
+
+@override_settings(REQUEST_TIMING_SAMPLE_RATE=1)
+class RequestTimingMiddlewareTests(CartTestCase):
+    def test_reports_server_timing_to_staff(self):
+        create_item('shirt')
+        self.assertFalse(self.client.get(reverse('core:home')).has_header('Server-Timing'))
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('core:home'))
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries, 0 duplicated"')
+        self.assertIn('template;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_flags_duplicated_queries(self):
+        metrics = RequestMetrics()
+        token = instrumentation.current.set(metrics)
+        try:
+            with connection.execute_wrapper(metrics.record_query):
+                for i in range(3):
+                    list(Item.objects.filter(pk=i))
+        finally:
+            instrumentation.current.reset(token)
+        self.assertEqual(list(metrics.duplicates(3).values()), [3])
+
+    @override_settings(REQUEST_TIMING_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_untouched(self):
+        self.assertFalse(self.client.get(reverse('core:home')).has_header('Server-Timing'))
+
+
+class ProfilingTests(CartTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings_override = override_settings(PROFILING_DIR=directory.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        create_item('shirt')
+
+    def test_staff_flag_profiles_and_lists_the_view(self):
+        self.client.get(reverse('core:home'), {'profile': '1'})
+        self.assertEqual(profiling.list_profiles(), {})
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get(reverse('core:home'), {'profile': '1'})
+        self.assertEqual(list(profiling.list_profiles()), ['HomeView.get'])
+
+        response = self.client.get(reverse('admin-profiles'))
+        self.assertContains(response, 'HomeView.get')
+        self.assertContains(response, 'Top cumulative functions')
+
+    @override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_URL_NAMES=['core:checkout'])
+    def test_allowlist_limits_sampling(self):
+        self.client.get(reverse('core:home'))
+        self.client.get(reverse('core:add-to-cart', kwargs={'slug': 'shirt'}))
+        self.assertEqual(profiling.list_profiles(), {})
+        self.client.get(reverse('core:checkout'))
+        self.assertEqual(list(profiling.list_profiles()), ['CheckoutView.get'])
+
+    @override_settings(PROFILING_SAMPLE_RATE=1)
+    def test_failed_saves_keep_the_response(self):
+        with mock.patch.object(profiling, 'save_profile', side_effect=OSError('No space left on device')), \
+                self.assertLogs('core.profiling', 'ERROR'):
+            response = self.client.get(reverse('core:home'))
+        self.assertContains(response, 'Shirt')
+
+
+@override_settings(METRICS_TOKEN='secret')
+class MetricsTests(CartTestCase):
+    def sample(self, name, **labels):
+        return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_exposes_latency_cart_and_open_cart_metrics(self):
+        create_item('shirt')
+        requests = self.sample('ecommerce_request_latency_seconds_count',
+                               url_name='core:add-to-cart', method='GET')
+        adds = self.sample('ecommerce_cart_operations_total', operation='add', result=cart.ADDED)
+        self.add('shirt')
+        self.assertEqual(self.sample('ecommerce_request_latency_seconds_count',
+                                     url_name='core:add-to-cart', method='GET'), requests + 1)
+        self.assertEqual(self.sample('ecommerce_cart_operations_total',
+                                     operation='add', result=cart.ADDED), adds + 1)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertContains(response, 'ecommerce_request_latency_seconds_bucket')
+        self.assertContains(response, 'ecommerce_open_carts 1.0')
+        self.assertContains(response, 'ecommerce_item_cache_lookups_total')
+
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        with self.settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def flaky(failures):
+            self.calls.append(failures)
+            if len(self.calls) <= failures:
+                raise ValueError('flaky')
+
+        patcher = mock.patch.dict(jobs.TASKS, {'flaky': flaky})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_idempotency_key_returns_the_queued_job(self):
+        job = jobs.enqueue('flaky', {'failures': 0}, key='once')
+        self.assertEqual(jobs.enqueue('flaky', {'failures': 0}, key='once').pk, job.pk)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(self.calls, [0])
+
+    def test_failures_are_retried_with_backoff(self):
+        job = jobs.enqueue('flaky', {'failures': 1})
+        with self.assertLogs('core.jobs', 'ERROR'):
+            self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (JOB_QUEUED, 1))
+        self.assertIn('ValueError: flaky', job.last_error)
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertEqual(jobs.run_pending(), 0)
+
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (JOB_DONE, 2))
+
+    def test_gives_up_after_max_attempts(self):
+        job = jobs.enqueue('flaky', {'failures': 1}, max_attempts=1)
+        with self.assertLogs('core.jobs', 'ERROR'):
+            jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, JOB_FAILED)
+        self.assertIsNotNone(job.finished)
+
+    def test_expired_leases_are_taken_over(self):
+        job = jobs.enqueue('flaky', {'failures': 0})
+        [crashed] = jobs.claim(10, worker='crashed')
+        self.assertEqual(jobs.claim(10), [])
+
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        [taken] = jobs.claim(10)
+        self.assertEqual(taken.attempts, 2)
+        self.assertTrue(jobs.run_job(taken))
+        # The crashed worker's late result is ignored
+        jobs.finish(crashed, status=JOB_FAILED)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, JOB_DONE)
+
+
+class RunWorkerTests(TransactionTestCase):
+    def test_thread_pool_drains_the_queue(self):
+        ran = []
+        with mock.patch.dict(jobs.TASKS, {'record': lambda number: ran.append(number)}):
+            for number in range(20):
+                jobs.enqueue('record', {'number': number})
+            call_command('runworker', threads=4, once=True, stdout=StringIO())
+        self.assertEqual(sorted(ran), list(range(20)))
+        self.assertEqual(Job.objects.filter(status=JOB_DONE).count(), 20)
+
+    def test_database_errors_do_not_stop_the_worker(self):
+        ran = []
+        claim = jobs.claim
+        failures = [OperationalError('server closed the connection unexpectedly')]
+
+        def flaky_claim(limit):
+            if failures:
+                raise failures.pop()
+            return claim(limit)
+
+        with mock.patch.dict(jobs.TASKS, {'record': lambda number: ran.append(number)}), \
+                mock.patch.object(jobs, 'claim', flaky_claim), self.assertLogs('core.jobs', 'ERROR'):
+            jobs.enqueue('record', {'number': 1})
+            jobs.work(1, poll_interval=0.01, once=True)
+        self.assertEqual(ran, [1])
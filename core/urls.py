@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from .views import (
     HomeView,
@@ -5,16 +6,22 @@ from .views import (
     OrderSummaryView,
     CheckoutView,
     PaymentView,
+    AsyncPaymentView,
     add_to_cart,
     remove_from_cart,
     remove_single_item_from_cart,
+    autocomplete_items,
     OrderConfirmedView,
     AddCouponView,
     RequestRefundView
 )
+from .webhooks import stripe_webhook
 
 app_name = 'core'
 
+if settings.ASYNC_PAYMENT_VIEWS:
+    PaymentView = AsyncPaymentView
+
 urlpatterns = [
     path('', HomeView.as_view(), name='home'),
     path('order-summary/', OrderSummaryView.as_view(), name='order-summary'),
@@ -27,5 +34,7 @@ urlpatterns = [
     path('remove-from-cart/<slug>/', remove_from_cart, name='remove-from-cart'),
     path('remove-single-item-from-cart/<slug>/',
          remove_single_item_from_cart, name='remove-single-item-from-cart'),
-    path('request-refund', RequestRefundView.as_view(), name='request-refund')
+    path('request-refund', RequestRefundView.as_view(), name='request-refund'),
+    path('autocomplete/', autocomplete_items, name='autocomplete'),
+    path('webhooks/stripe/', stripe_webhook, name='stripe-webhook')
 ]
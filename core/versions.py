@@ -0,0 +1,28 @@
+import time
+
+from django.core.cache import cache
+
+# Version counters in Django's cache. Readers compare the current version
+# with the one their cached data was built from, writers bump it on change.
+
+
+def version_key(name):
+    return f'version:{name}'
+
+
+def get_version(name):
+    version = cache.get(version_key(name))
+    if version is None:
+        # Start from the clock, so a version lost to eviction never
+        # repeats one a reader has already seen
+        cache.add(version_key(name), int(time.time() * 1000), None)
+        version = cache.get(version_key(name))
+    return version
+
+
+def bump_version(name):
+    try:
+        return cache.incr(version_key(name))
+    except ValueError:
+        get_version(name)
+        return cache.incr(version_key(name))
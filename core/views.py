@@ -1,45 +1,90 @@
 import stripe
-import json
-import random
-import string
 
-from django.urls import reverse
-from django.shortcuts import render, get_object_or_404, redirect
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.http import Http404, JsonResponse
+from django.shortcuts import render, redirect
 from django.core.exceptions import ObjectDoesNotExist
 from django.views.generic import ListView, DetailView, View
-from django.utils import timezone
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.conf import settings
+from django.db import transaction
+from django.utils.decorators import method_decorator
 
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund
+from .models import Item, Order, Coupon, Refund, CATEGORY_CHOICES
 from .forms import CheckoutForm, CouponForm, RefundForm
+from .page_cache import anonymous_page_cache
+from .pagination import KeysetPaginator, InvalidCursor
+from . import autocomplete, cart, checkout, item_cache, metrics, payments, search
 
 stripe_public_key = settings.STRIPE_PUBLIC_KEY
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
-# Create Reference Code for Products
-def create_ref_code():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
 
 # Homepage View
+@method_decorator(anonymous_page_cache, name='dispatch')
 class HomeView(ListView):
     model = Item
     template_name = 'home.html'
     paginate_by = 10
+    ordering = ['id']
+    # Cursor based paging, set to False to fall back to ?page=N offsets
+    keyset_pagination = True
+
+    def get_queryset(self):
+        queryset = Item.objects.all()
+        category = self.request.GET.get('category')
+        if category in dict(CATEGORY_CHOICES):
+            queryset = queryset.filter(category=category)
+
+        query = self.request.GET.get('q', '').strip()
+        if query:
+            queryset = search.search_items(queryset, query)
+        return queryset.order_by(*self.get_ordering())
+
+    def get_ordering(self):
+        # Ranked search results keep the best matches on the first page
+        if self.request.GET.get('q', '').strip():
+            return ['search_rank', 'id']
+        return super().get_ordering()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        params = self.request.GET.copy()
+        params.pop('cursor', None)
+        params.pop('page', None)
+        context.update({
+            'category': self.request.GET.get('category', ''),
+            'query': self.request.GET.get('q', ''),
+            'filter_params': params.urlencode()
+        })
+        return context
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(queryset, page_size, self.get_ordering())
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        return (paginator, page, page.object_list, page.has_other_pages())
 
 # Single Product View
+@method_decorator(anonymous_page_cache, name='dispatch')
 class ItemDetailView(DetailView):
     model = Item
     template_name = 'products.html'
 
+    def get_object(self, queryset=None):
+        return item_cache.get_item_or_404(slug=self.kwargs['slug'])
+
 # Order Summary View
 class OrderSummaryView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         try:
             # Get users orders than have not been ordered
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.with_items().get(user=self.request.user, ordered=False)
             context = {
                 'object': order
             }
@@ -48,12 +93,12 @@ class OrderSummaryView(LoginRequiredMixin, View):
             messages.error(self.request, "You do not have an active order")
             return redirect('/')
 
-def is_valid_form(values):
-    valid = True
-    for field in values:
-        if field == '':
-            valid = False
-    return valid
+ADDRESS_ERRORS = {
+    checkout.NO_DEFAULT_SHIPPING: 'No default shipping address available',
+    checkout.NO_DEFAULT_BILLING: 'No default billing address available',
+    checkout.INCOMPLETE_SHIPPING: 'Please fill in the required shipping address fields',
+    checkout.INCOMPLETE_BILLING: 'Please fill in the required billing address fields',
+}
 
 # Checkout View
 class CheckoutView(View):
@@ -61,7 +106,7 @@ class CheckoutView(View):
         try:
             form = CheckoutForm()
             # Get users orders than have not been ordered
-            order = Order.objects.get(
+            order = Order.objects.with_items().get(
                 user=self.request.user,
                 ordered=False
             )
@@ -74,25 +119,12 @@ class CheckoutView(View):
                 'user': self.request.user
             }
 
-            # Get default shipping address for user if it exists
-            shipping_address_qs = Address.objects.filter(
-                user=self.request.user, 
-                address_type='S', 
-                default=True
-            )
-            # Check if default shipping address for user does exist and parse to context
-            if shipping_address_qs.exists():
-                context.update({'default_shipping_address': shipping_address_qs[0]})
-
-            # Get default billing address for user if it exists
-            billing_address_qs = Address.objects.filter(
-                user=self.request.user, 
-                address_type='B', 
-                default=True
-            )
-            # Check if default billing address for user does exist and parse to context
-            if billing_address_qs.exists():
-                context.update({'default_billing_address': billing_address_qs[0]})
+            # Get default shipping and billing addresses for user if they exist
+            defaults = checkout.default_addresses(self.request.user.pk)
+            if checkout.SHIPPING in defaults:
+                context.update({'default_shipping_address': defaults[checkout.SHIPPING]})
+            if checkout.BILLING in defaults:
+                context.update({'default_billing_address': defaults[checkout.BILLING]})
 
             return render(self.request, 'checkout.html', context)
 
@@ -101,146 +133,17 @@ class CheckoutView(View):
             return redirect('core:checkout')
 
     def post(self, *args, **kwargs):
+        metrics.CHECKOUT_SUBMISSIONS.inc()
         form = CheckoutForm(self.request.POST or None)
         try:
             # Get users orders than have not been ordered
             order = Order.objects.get(user=self.request.user, ordered=False)
 
             if form.is_valid():
-                 ### Shipping Address ###
-                use_default_shipping = form.cleaned_data.get('use_default_shipping')
-
-                # Check if user wants to use default shipping address
-                if use_default_shipping:
-                    print('using default shipping')
-
-                    # Get default shipping address for user
-                    address_qs = Address.objects.filter(
-                        user=self.request.user, 
-                        address_type='S', 
-                        default=True
-                    )
-
-                    # Check if default shipping address does exist for user and assign to order
-                    if address_qs.exists():
-                        shipping_address = address_qs[0]
-                        order.shipping_address = shipping_address
-                        order.save()
-                    else:
-                        messages.info(self.request, 'No default shipping address available')
-                        return redirect('core:checkout')
-                
-                # If the user does not want to use default shipping address
-                else:
-                    print('Not using default shipping')
-                    # Get form data
-                    shipping_first_name = form.cleaned_data.get('shipping_first_name')
-                    shipping_last_name = form.cleaned_data.get('shipping_last_name')
-                    shipping_address1 = form.cleaned_data.get('shipping_address')
-                    shipping_address2 = form.cleaned_data.get('shipping_address2')
-                    shipping_country = form.cleaned_data.get('shipping_country')
-                    shipping_zip = form.cleaned_data.get('shipping_zip')
-
-                    # Check against empty inputs
-                    if is_valid_form([shipping_address1, shipping_country, shipping_zip,shipping_first_name, shipping_last_name]):
-                        # Create shipping address object
-                        shipping_address = Address(
-                            user = self.request.user,
-                            first_name = shipping_first_name,
-                            last_name = shipping_last_name,
-                            street_address = shipping_address1,
-                            apartment_address = shipping_address2,
-                            country = shipping_country,
-                            zip = shipping_zip,
-                            address_type = 'S'
-                        )
-                        shipping_address.save()
-
-                        # Assign shipping address to order
-                        order.shipping_address = shipping_address
-                        order.save()
-
-                        # If user wants to use address as default shipping address
-                        set_default_shipping = form.cleaned_data.get('set_default_shipping')
-                        if set_default_shipping:
-                            shipping_address.default = True
-                            shipping_address.save()
-                    else:
-                        messages.info(self.request, 'Please fill in the required shipping address fields')
-
-                ### Billing Address ###
-                use_default_billing = form.cleaned_data.get('use_default_billing')
-                same_billing_address = form.cleaned_data.get('same_billing_address')
-
-                # Check if billing address is the same as shipping address (from user input)
-                if same_billing_address:
-                    billing_address = shipping_address
-                    billing_address.pk = None
-                    billing_address.save()
-                    billing_address.address_type = 'B'
-                    billing_address.save()
-                    # Assign billing address to order
-                    order.billing_address = billing_address
-                    order.save()
-
-                # Check if user wants to use default billing address
-                elif use_default_billing:
-                    print('using default billing')
-
-                    # Get default billing address for user
-                    address_qs = Address.objects.filter(
-                        user=self.request.user, 
-                        address_type='B', 
-                        default=True
-                    )
-
-                    # Check if default billing address does exist for user and assign to order
-                    if address_qs.exists():
-                        billing_address = address_qs[0]
-                        order.billing_address = billing_address
-                        order.save()
-                    else:
-                        messages.info(self.request, 'No default billing address available')
-                        return redirect('core:checkout')
-                
-                # If the user does not want to use default billing address
-                else:
-                    print('User is entering new billing address')
-                    # Get form data
-                    billing_first_name = form.cleaned_data.get('billing_first_name')
-                    billing_last_name = form.cleaned_data.get('billing_last_name')
-                    billing_address1 = form.cleaned_data.get('billing_address')
-                    billing_address2 = form.cleaned_data.get('billing_address2')
-                    billing_country = form.cleaned_data.get('billing_country')
-                    billing_zip = form.cleaned_data.get('billing_zip')
-
-                    # Check against empty inputs
-                    if is_valid_form([billing_address1, billing_country, billing_zip, billing_first_name, billing_last_name]):
-                        # Create billing address object
-                        billing_address = Address(
-                            user = self.request.user,
-                            first_name = billing_first_name,
-                            last_name = billing_last_name,
-                            street_address = billing_address1,
-                            apartment_address = billing_address2,
-                            country = billing_country,
-                            zip = billing_zip,
-                            address_type = 'B'
-                        )
-                        billing_address.save()
-
-                        # Assign billing address to order
-                        order.billing_address = billing_address
-                        order.save()
-
-                        # If user wants to use address as default billing address
-                        set_default_billing = form.cleaned_data.get('set_default_billing')
-                        if set_default_billing:
-                            billing_address.default = True
-                            billing_address.save()
-                    else:
-                        messages.info(self.request, 'Please fill in the required billing address fields')
-
+                error = checkout.set_addresses(order, form.cleaned_data)
+                if error:
+                    messages.info(self.request, ADDRESS_ERRORS[error])
+                    return redirect('core:checkout')
 
                 payment_option = form.cleaned_data.get('payment_option')
                 
@@ -258,30 +161,37 @@ class CheckoutView(View):
             messages.error(self.request, "You do not have an active order")
             return redirect('core:order-summary')
         
+def payment_context(request, order, intent_id, client_secret):
+    return {
+        'client_secret': client_secret,
+        'stripe_public_key': stripe_public_key,
+        'intent_id': intent_id,
+        'order': order,
+        'DISPLAY_COUPON_FORM': False,
+        'user_name': f'{request.user.first_name} {request.user.last_name}'
+    }
+
+def open_order(user):
+    return Order.objects.with_items().select_related('billing_address').get(
+        user=user,
+        ordered=False
+    )
+
 class PaymentView(View):
     def get(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        amount = int(order.get_total() * 100)
-        user_name = f'{self.request.user.first_name} {self.request.user.last_name}'
+        order = open_order(self.request.user)
+        amount = payments.order_amount(order)
 
         if order.billing_address:
-            # Create payment intent
-            intent = stripe.PaymentIntent.create(
-                amount=amount,
-                currency='eur',
-                # Verify your integration in this guide by including this parameter
-                metadata={'integration_check': 'accept_a_payment'},
-            )
-
-            context = {
-                'client_secret': intent.client_secret,
-                'stripe_public_key': stripe_public_key,
-                'intent_id': intent.id,
-                'order': order,
-                'DISPLAY_COUPON_FORM': False,
-                'user_name': user_name
-            }
+            # Create or reuse the order's payment intent
+            try:
+                result, intent_id, client_secret = payments.payment_intent(order, amount)
+            except stripe.error.StripeError as e:
+                metrics.PAYMENT_INTENTS.labels(result=type(e).__name__).inc()
+                raise
+            metrics.PAYMENT_INTENTS.labels(result=result).inc()
 
+            context = payment_context(self.request, order, intent_id, client_secret)
             return render(self.request, 'payment.html', context)
 
         else:
@@ -289,68 +199,71 @@ class PaymentView(View):
             return redirect('core:checkout')
     
 class OrderConfirmedView(View):
-    def post(self, *args, **kwargs):
-        form = self.request.POST
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        intent_id = form.get('intent_id')
+    # Only reads the order, the payment_intent.succeeded webhook completes it
+    # (core.webhooks). Until then the page refreshes itself, up to
+    # `max_refreshes` times, and asks the customer to contact us when the
+    # payment could not be matched or takes that long
+    max_refreshes = 30
+
+    def get(self, *args, **kwargs):
+        intent_id = self.request.GET.get('intent_id')
+        order = None
+        if intent_id:
+            order = Order.objects.with_items().filter(
+                user=self.request.user, stripe_intent_id=intent_id).first()
+        if order is None:
+            messages.error(self.request, "Your payment has not been completed")
+            return redirect('core:payment', payment_option='stripe')
 
         try:
-            # create the payment
-            payment = Payment()
-            payment.stripe_charge_id = intent_id
-            payment.user = self.request.user
-            payment.amount = order.get_total()
-            payment.save()
-
-            #assign payment to order
-            order_items = order.items.all()
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
-
-            order.ordered = True
-            order.payment = payment
-            order.ref_code = create_ref_code()
-            order.save()
+            refreshes = int(self.request.GET.get('refresh', 0))
+        except ValueError:
+            refreshes = 0
+        stuck = not order.ordered and (order.payment_problem or refreshes >= self.max_refreshes)
+        context = {
+            'order': order,
+            'pending': not order.ordered and not stuck,
+            'stuck': stuck,
+            'intent_id': intent_id,
+            'next_refresh': refreshes + 1
+        }
+        return render(self.request, 'order_confirmation.html', context)
 
-            context = {
-                'order': order
-            }
+class AsyncView(View):
+    # A View whose handlers are coroutines, Django 3.2's as_view() does not
+    # mark the view function as one itself
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return markcoroutinefunction(super().as_view(**initkwargs))
 
-            return render(self.request, 'order_confirmation.html', context)
+    async def http_method_not_allowed(self, request, *args, **kwargs):
+        return super().http_method_not_allowed(request, *args, **kwargs)
 
-        except stripe.error.CardError as e:
-            # Since it's a decline, stripe.error.CardError will be caught
-            messages.error(self.request, f"{e.error.message}")
-            return redirect('/')
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            messages.error(self.request, f"{e.error.message}")
-            return redirect('/')
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            messages.error(self.request, f"{e.error.message}")
-            return redirect('/')
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.error(self.request, f"{e.error.message}")
-            return redirect('/')
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            messages.error(self.request, f"{e.error.message}")
-            return redirect('/')
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
-            messages.error(self.request, f"{e.error.message}")
-            return redirect('/')
-        except Exception as e:
-            # Send email to ourselves
-            messages.error(self.request, "A serious error has occured, we have been notified and will look into it")
-            pass
+    async def options(self, request, *args, **kwargs):
+        return super().options(request, *args, **kwargs)
 
-       
+# Used instead of PaymentView with ASYNC_PAYMENT_VIEWS, under ASGI a worker
+# then serves other requests while Stripe answers. The ORM and template work
+# runs in sync_to_async
+class AsyncPaymentView(AsyncView):
+    async def get(self, *args, **kwargs):
+        order = await sync_to_async(open_order)(self.request.user)
+        amount = payments.order_amount(order)
+
+        if order.billing_address:
+            try:
+                result, intent_id, client_secret = await payments.payment_intent_async(order, amount)
+            except stripe.error.StripeError as e:
+                metrics.PAYMENT_INTENTS.labels(result=type(e).__name__).inc()
+                raise
+            metrics.PAYMENT_INTENTS.labels(result=result).inc()
+
+            context = payment_context(self.request, order, intent_id, client_secret)
+            return await sync_to_async(render)(self.request, 'payment.html', context)
+
+        else:
+            messages.error(self.request, "You did not provide a billing address")
+            return redirect('core:checkout')
 
 class RequestRefundView(View):
     def get(self, *args, **kwargs):
@@ -369,15 +282,11 @@ class RequestRefundView(View):
             email = form.cleaned_data.get('email')
 
             try:
-                order = Order.objects.get(ref_code=ref_code)
-                order.refund_requested = True
-                order.save()
-            
-                refund = Refund()
-                refund.order = order
-                refund.reason = message
-                refund.email = email
-                refund.save()
+                order = Order.objects.only('pk').get(ref_code=ref_code)
+                # Accepted and issued from the admin, see core.refunds
+                with transaction.atomic():
+                    Order.objects.filter(pk=order.pk).update(refund_requested=True)
+                    Refund.objects.create(order=order, reason=message, email=email)
 
                 messages.info(self.request, 'Your request has been received.')
                 return redirect('core:request-refund')
@@ -387,105 +296,56 @@ class RequestRefundView(View):
                 return redirect('core:request-refund')
 
 def add_to_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
+    item = item_cache.get_item_or_404(slug=slug)
 
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item,
-        user=request.user,
-        ordered=False
-    )
+    result = cart.add_item(request.user, item)
+    metrics.CART_OPERATIONS.labels(operation='add', result=result).inc()
 
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "Item quantity updated")
-            return redirect('core:order-summary')
-        else:
-            messages.info(request, "This item was added to your cart")
-            order.items.add(order_item)
-            return redirect('core:order-summary')
+    if result == cart.UPDATED:
+        messages.info(request, "Item quantity updated")
     else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(
-            user=request.user,
-            ordered_date=ordered_date,
-        )
-        order.items.add(order_item)
         messages.info(request, "This item was added to your cart")
-        return redirect("core:order-summary")
+    return redirect('core:order-summary')
 
 @login_required
 def remove_from_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            order.items.remove(order_item)
-            order_item.delete()
-            messages.info(request, "This item was removed from your cart")
-            return redirect("core:order-summary")
-
-        else:
-            messages.info(request, "This item was not in your cart")
-            return redirect('core:product', slug=slug)
+    item = item_cache.get_item_or_404(slug=slug)
+    result = cart.remove_item(request.user, item)
+    metrics.CART_OPERATIONS.labels(operation='remove', result=result).inc()
 
+    if result == cart.REMOVED:
+        messages.info(request, "This item was removed from your cart")
+        return redirect("core:order-summary")
+    elif result == cart.NOT_IN_CART:
+        messages.info(request, "This item was not in your cart")
     else:
         messages.info(request, "There is nothing in your cart")
-        return redirect('core:product', slug=slug)
+    return redirect('core:product', slug=slug)
 
 
 @login_required
 def remove_single_item_from_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order.items.remove(order_item)
-                order_item.save()
-            messages.info(request, "This items quantity was updated")
-            return redirect("core:order-summary")
-
-        else:
-            messages.info(request, "This item was not in your cart")
-            return redirect('core:product', slug=slug)
+    item = item_cache.get_item_or_404(slug=slug)
+    result = cart.remove_single_item(request.user, item)
+    metrics.CART_OPERATIONS.labels(operation='remove_single', result=result).inc()
 
+    if result == cart.UPDATED:
+        messages.info(request, "This items quantity was updated")
+        return redirect("core:order-summary")
+    elif result == cart.NOT_IN_CART:
+        messages.info(request, "This item was not in your cart")
     else:
         messages.info(request, "There is nothing in your cart")
-        return redirect('core:product', slug=slug)
+    return redirect('core:product', slug=slug)
+
+def autocomplete_items(request):
+    try:
+        limit = int(request.GET.get('limit', 8))
+    except ValueError:
+        limit = 8
+
+    results = autocomplete.suggest(request.GET.get('q', ''), max(limit, 1))
+    return JsonResponse({'results': results})
 
 def get_coupon(request, code):
     try:
@@ -506,7 +366,10 @@ class AddCouponView(View):
                     ordered=False
                 )
                 order.coupon = get_coupon(self.request, code)
-                order.save()
+                metrics.COUPON_APPLICATIONS.labels(
+                    result='applied' if order.coupon else 'unknown_code'
+                ).inc()
+                order.update_totals(extra_fields=['coupon'])
                 messages.success(self.request, 'Successfully added coupon')
                 return redirect('core:checkout')
                 
@@ -0,0 +1,136 @@
+import json
+import logging
+import traceback
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import jobs, metrics, payments
+from .models import Order, WebhookEvent
+
+# Stripe webhooks. The endpoint verifies the signature, appends the event to
+# the WebhookEvent inbox and answers at once; redeliveries of an event are
+# dropped by its unique id. Each payment_intent.succeeded event gets a job
+# in the same transaction, which completes the orders of pending events in
+# batches, oldest first, until its own event is done. Events arriving
+# together are handled by the first job's batch and the jobs of the others
+# stop after one query. An event that fails is marked processed with its
+# error and left to the admins, so it cannot hold up the ones behind it.
+PROCESS_EVENTS = 'process_webhook_events'
+PAYMENT_SUCCEEDED = 'payment_intent.succeeded'
+
+logger = logging.getLogger(__name__)
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        raise Http404('Webhooks are not configured')
+
+    payload = request.body.decode()
+    try:
+        event = stripe.Webhook.construct_event(
+            payload, request.headers.get('Stripe-Signature', ''), settings.STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return HttpResponseBadRequest()
+
+    with transaction.atomic():
+        WebhookEvent.objects.bulk_create([
+            WebhookEvent(event_id=event.id, type=event.type, payload=payload)
+        ], ignore_conflicts=True)
+        if event.type == PAYMENT_SUCCEEDED:
+            jobs.enqueue(PROCESS_EVENTS, {'event_id': event.id}, key=f'webhook-{event.id}')
+    return HttpResponse()
+
+
+def paid_intents(events, errors):
+    # {intent id: (event, PaymentIntent)} of the payment_intent.succeeded
+    # events, the tracebacks of events that cannot be read go to `errors`
+    intents = {}
+    for event in events:
+        if event.type != PAYMENT_SUCCEEDED:
+            continue
+        try:
+            intent = stripe.Event.construct_from(json.loads(event.payload), stripe.api_key).data.object
+            intents[intent.id] = (event, intent)
+        except Exception:
+            logger.exception('Could not read webhook event %s', event.event_id)
+            errors[event.pk] = traceback.format_exc()
+    return intents
+
+
+def payment_problem(intent_id, problem, order=None):
+    # A customer paid for something we cannot match, someone has to look.
+    # The order's confirmation page tells the customer to contact us
+    logger.error('Payment %s: %s', intent_id, problem)
+    if order is not None:
+        Order.objects.filter(pk=order.pk).update(payment_problem=True)
+    jobs.enqueue('mail_admins', {
+        'subject': f'Payment {intent_id} needs attention',
+        'message': f'PaymentIntent {intent_id}: {problem}'
+    })
+
+
+def process_batch(batch_size):
+    # Completes the orders of up to `batch_size` pending events in one
+    # transaction, each in a savepoint of its own, and marks the events
+    # processed. Returns how many there were
+    events = list(WebhookEvent.objects.filter(processed=None).order_by('pk')[:batch_size])
+    if not events:
+        return 0
+
+    errors = {}
+    intents = paid_intents(events, errors)
+    with transaction.atomic():
+        # Locked, so no cart change lands between the amount check and the
+        # completion (a no-op on SQLite)
+        orders = Order.objects.select_for_update().filter(
+            stripe_intent_id__in=intents, ordered=False).order_by('pk')
+        for order in orders:
+            event, intent = intents.pop(order.stripe_intent_id)
+            try:
+                with transaction.atomic():
+                    payments.check_paid(order, intent)
+                    payments.finalize_order(order, order.user_id, intent.amount)
+            except payments.AlreadyOrdered:
+                # Completed by a concurrent batch
+                pass
+            except payments.PaymentIncomplete:
+                metrics.PAYMENT_ERRORS.labels(error='PaymentIncomplete').inc()
+                payment_problem(intent.id, f'paid {intent.amount} {intent.currency} for order '
+                                           f'{order.pk} of {payments.order_amount(order)}', order)
+            except Exception as e:
+                logger.exception('Could not complete order %s of webhook event %s', order.pk, event.event_id)
+                errors[event.pk] = traceback.format_exc()
+                metrics.PAYMENT_ERRORS.labels(error=type(e).__name__).inc()
+                payment_problem(intent.id, f'completing order {order.pk} failed: {e!r}', order)
+
+        # Left: intents of orders completed before, or of no order at all
+        completed = set(Order.objects.filter(
+            stripe_intent_id__in=intents, ordered=True).values_list('stripe_intent_id', flat=True))
+        for intent_id in intents.keys() - completed:
+            payment_problem(intent_id, 'no order uses this intent')
+
+        now = timezone.now()
+        for pk, error in errors.items():
+            WebhookEvent.objects.filter(pk=pk).update(processed=now, error=error)
+        WebhookEvent.objects.filter(pk__in=[event.pk for event in events], processed=None).update(
+            processed=now)
+    return len(events)
+
+
+@jobs.task(PROCESS_EVENTS)
+def process_events(event_id=None, batch_size=None):
+    # Works through pending events until `event_id` is processed, or until
+    # none is left without one
+    pending = WebhookEvent.objects.filter(processed=None)
+    if event_id is not None:
+        pending = pending.filter(event_id=event_id)
+    while pending.exists() and process_batch(batch_size or settings.WEBHOOK_BATCH_SIZE):
+        pass
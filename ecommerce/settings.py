@@ -37,20 +37,23 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware'
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.middleware.ProfilingMiddleware'
 ]
 
 ROOT_URLCONF = 'ecommerce.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'core.instrumentation.TimedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -87,6 +90,17 @@ DATABASES = {
     }
 }
 
+# Catalog versions, cart badges, item lookups and default addresses are
+# cached. By default in each process' own memory: a change is then only seen
+# at once by the process that made it, the others serve their copy until it
+# expires (an hour for cart badges and item lookups). Deployments running
+# more than one process set CACHE_BACKEND and CACHE_LOCATION to a shared
+# in-memory cache, e.g. django.core.cache.backends.memcached.PyMemcacheCache
+# and 127.0.0.1:11211 with pymemcache installed
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND')
+if CACHE_BACKEND:
+    CACHES = {'default': {'BACKEND': CACHE_BACKEND, 'LOCATION': os.environ.get('CACHE_LOCATION', '')}}
+
 AUTHENTICATION_BACKENDS = (
     # Needed to login by username in Django admin, regardless of `allauth`
     'django.contrib.auth.backends.ModelBackend',
@@ -137,5 +151,70 @@ LOGIN_REDIRECT_URL = '/'
 # crispy forms
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
+# Share of requests timed by core.middleware.RequestTimingMiddleware, staff
+# users see the timings in a Server-Timing header
+REQUEST_TIMING_SAMPLE_RATE = float(os.environ.get('REQUEST_TIMING_SAMPLE_RATE', '0'))
+REQUEST_TIMING_LOG = os.environ.get('REQUEST_TIMING_LOG') == 'True'
+
+# Request profiling, see core.profiling. Requests are profiled when sampled,
+# when sent with an X-Profile-Token header matching PROFILING_TOKEN or when
+# a staff user adds ?profile=1; PROFILING_URL_NAMES (e.g. core:checkout)
+# restricts all of these to the listed views
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+PROFILING_URL_NAMES = [name for name in os.environ.get('PROFILING_URL_NAMES', '').split(',') if name]
+PROFILING_DIR = os.environ.get('PROFILING_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+# /metrics requires an 'Authorization: Bearer <token>' header, and is not
+# served when unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Serve anonymous catalog and product pages from core.page_cache
+ANONYMOUS_PAGE_CACHE = os.environ.get('ANONYMOUS_PAGE_CACHE') == 'True'
+
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
-STRIPE_PUBLIC_KEY = os.environ.get('STRIPE_PUBLIC_KEY')
\ No newline at end of file
+STRIPE_PUBLIC_KEY = os.environ.get('STRIPE_PUBLIC_KEY')
+
+# Point at core.tests.fake_stripe or stripe-mock for offline testing
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE', 'https://api.stripe.com')
+# Seconds before a Stripe call from the async payment views times out
+STRIPE_TIMEOUT = float(os.environ.get('STRIPE_TIMEOUT', 10))
+# Signing secret of the /webhooks/stripe/ endpoint, orders are completed by
+# its payment_intent.succeeded events (core.webhooks). Required for card
+# payments: without it the endpoint answers 404 and paid orders stay pending.
+# The events are processed by a running `manage.py runworker`
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
+
+# Serve the payment page with the async view, for ASGI deployments
+# (ecommerce.asgi)
+ASYNC_PAYMENT_VIEWS = os.environ.get('ASYNC_PAYMENT_VIEWS') == 'True'
+
+# Background jobs, see core.jobs, run by `manage.py runworker`: webhook
+# events, refunds, large admin actions and admin mails wait for it. A failed
+# job is retried after JOB_RETRY_DELAY seconds, doubling with each attempt up
+# to JOB_RETRY_MAX_DELAY
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', 10))
+JOB_RETRY_MAX_DELAY = float(os.environ.get('JOB_RETRY_MAX_DELAY', 60 * 60))
+# Seconds a worker may spend on a job before others take it over
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 5 * 60))
+JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS', 4))
+
+# Webhook events processed per transaction by core.webhooks
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', 100))
+
+# Refunds issued by core.refunds: per job chunk, calls at the same time,
+# calls per second per worker process, and tries of a rate limited or
+# failed connection, REFUND_RETRY_DELAY seconds apart doubling each time
+REFUND_BATCH_SIZE = int(os.environ.get('REFUND_BATCH_SIZE', 100))
+REFUND_THREADS = int(os.environ.get('REFUND_THREADS', 8))
+REFUND_RATE_LIMIT = float(os.environ.get('REFUND_RATE_LIMIT', 20))
+REFUND_MAX_ATTEMPTS = int(os.environ.get('REFUND_MAX_ATTEMPTS', 4))
+REFUND_RETRY_DELAY = float(os.environ.get('REFUND_RETRY_DELAY', 1))
+
+# Admin order actions, see core.bulk: orders changed per transaction, the
+# largest selection changed within the request and the seconds a job spends
+# on a run before handing the rest to a new one
+BULK_ACTION_BATCH_SIZE = int(os.environ.get('BULK_ACTION_BATCH_SIZE', 1000))
+BULK_ACTION_INLINE_LIMIT = int(os.environ.get('BULK_ACTION_INLINE_LIMIT', 5000))
+BULK_ACTION_JOB_SECONDS = float(os.environ.get('BULK_ACTION_JOB_SECONDS', 30))
\ No newline at end of file
@@ -2,10 +2,14 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
+from core.admin import profiles_view
+from core.metrics import metrics_view
 
 urlpatterns = [
+    path('admin/profiles/', profiles_view, name='admin-profiles'),
     path('admin/', admin.site.urls),
     path('accounts/', include('allauth.urls')),
+    path('metrics', metrics_view, name='metrics'),
     path('', include('core.urls', namespace='core'))
 ]
 